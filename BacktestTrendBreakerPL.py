@@ -1,32 +1,278 @@
 import backtrader as bt
 import pandas as pd
 import numpy as np
-from scipy import stats
-import matplotlib.pyplot as plt
-from DataFeedFormat import FinamHLOC
+import functools
+import time
+from DataFeedFormat import FinamArrays
+from DataCache import load_finam_candles, read_candle_blocks, finam_cache, BLOCK_SIZE
 from TrendBreakerPLStrategy import TrendBreakerPL
-import pyfolio as pf
-import seaborn as sns
-sns.set_style("whitegrid")
+from EquityRecorderAnalyzer import EquityRecorder
+from PivotPointLineIndicator import pivot_point_line_lines, pivot_point_line_blocks
+from Pruner import max_drawdown
+from Instrumentation import stage, staged
+from ResultStore import ResultStore
+from FastSimulator import simulate, BatchSimulation, EquityStream, period_ids, period_returns, period_keys, \
+    correlation_of_covariance
+# pyfolio, matplotlib and seaborn are imported only for the performance report and the plots,
+# so the optimization workers don't pay for them
+
+
+# Results of the backtest, the returns are kept as numpy arrays and turned into pandas only for the reports
+class BacktestResult:
+    def __init__(self, final_value, total_return, stability, dates, period_returns, max_drawdown, recording=None):
+        self.final_value = final_value
+        self.total_return = total_return
+        self.stability = stability
+        # Returns of the periods of TimeReturn analyzer and their datetimes (datetime64[ns]), None for the chunked
+        # engine, it keeps only the metrics of them
+        self.dates = dates
+        self.period_returns = period_returns
+        self.max_drawdown = max_drawdown
+        # Arrays of EquityRecorder (cerebro only): the values, the fills and the trades
+        self.recording = recording
+
+    # Metrics and arrays for ResultStore
+    def to_store(self, runtime):
+        metrics = {'final_value': self.final_value,
+                   'total_return': self.total_return,
+                   'stability': self.stability,
+                   'max_drawdown': self.max_drawdown,
+                   'trades': len(self.recording['trade_pnl']) if self.recording is not None else None,
+                   'runtime': runtime}
+        arrays = {}
+        if self.period_returns is not None:
+            arrays.update({'dates': np.asarray(self.dates, dtype='datetime64[ns]').astype(np.int64),
+                           'period_returns': self.period_returns})
+        if self.recording is not None:
+            arrays.update({'recording_' + name: values for name, values in self.recording.items()})
+        return metrics, arrays
+
+    @staticmethod
+    def from_store(metrics, arrays):
+        recording = {name[len('recording_'):]: values for name, values in arrays.items()
+                     if name.startswith('recording_')}
+        dates = arrays['dates'].astype('datetime64[ns]') if 'dates' in arrays else None
+        return BacktestResult(metrics['final_value'], metrics['total_return'], metrics['stability'],
+                              dates, arrays.get('period_returns'), metrics['max_drawdown'], recording or None)
+
+    # Series of the returns as TimeReturn analyzer gives them, None if they aren't kept
+    @property
+    def returns(self):
+        if self.period_returns is None:
+            return None
+        return pd.Series(self.period_returns, index=pd.DatetimeIndex(self.dates, name='date'), name='return')
+
+    def __repr__(self):
+        return 'BacktestResult(final_value={0}, total_return={1}, stability={2})'.format(
+            self.final_value, self.total_return, self.stability)
+
+
+# Broker of cerebro with its work recorded as the stage of the instrumentation
+class InstrumentedBroker(bt.brokers.BackBroker):
+    @staged('broker')
+    def next(self):
+        super(InstrumentedBroker, self).next()
+
+
+# Decorator running the method with the instrumentation of the backtest activated, as the stage of its name
+def instrumented(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.instrumentation is None:
+            return method(self, *args, **kwargs)
+        with self.instrumentation.activate(), self.instrumentation.stage(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class BacktestTrendBreakerPL:
     def __init__(self,
                  file_data,
                  algo_params,
-                 output_settings
+                 output_settings,
+                 candles=None,
+                 indicator_cache=None,
+                 window=None,
+                 instrumentation=None,
+                 result_store=None
                  ):
         self.file_data = file_data
         self.algo_params = algo_params
         self.output_settings = output_settings
+        # Instrumentation recording the stages of the runs: wall time, calls and allocations. The same one can be
+        # passed to many backtests, e.g. the evaluations of the optimization, to sum their stages.
+        self.instrumentation = instrumentation
+        # Candles of file_data from the binary cache, it can be loaded once and shared by many backtests
+        if candles is None and instrumentation is not None:
+            with instrumentation.activate():
+                candles = load_finam_candles(file_data)
+        self.candles = candles if candles is not None else load_finam_candles(file_data)
+        # Results of PivotPointLine shared by the backtests with the same indicator params (see IndicatorCache)
+        self.indicator_cache = indicator_cache
+        # Bars [start, stop) of the candles to trade. The indicator of the window is warmed up by the bars before it
+        # by all the engines, the trading and the returns start at the first bar of the window.
+        self.window = window
+        self.bars = slice(*window) if window is not None else slice(None)
+        # ResultStore serving the runs made before instead of running them again
+        self.result_store = result_store
+
+    # engine='fast' runs the same strategy with FastSimulator instead of cerebro (no order and trade logs),
+    # engine='chunked' runs FastSimulator out of core: the candles are read from the cache in blocks of block_size bars,
+    # only the metrics of the returns are kept (no returns series, so no performance report and plots)
+    # With the result store the run is served from it if it's there (unless the order and trade logs are enabled)
+    # Returns BacktestResult, nothing is printed or plotted unless it's enabled in output_settings
+    @instrumented
+    def run_strategy(self, cash=1000, commission=0.0004, tf=bt.TimeFrame.Minutes, compression=60, engine='cerebro',
+                     block_size=BLOCK_SIZE):
+        if engine == 'chunked' and (self.output_settings['performance'] or self.output_settings['plot']):
+            raise ValueError('The chunked engine keeps no returns for the performance report and the plots')
+        if self.output_settings['performance']:
+            print('Starting Portfolio Value: %.2f' % cash)
+
+        logs = self.output_settings['order_full'] or self.output_settings['order_status'] or \
+            self.output_settings['trades']
+        stored = None
+        if self.result_store is not None:
+            params = ResultStore.make_params(self.candles, self.window, engine, self.algo_params,
+                                             cash, commission, tf, compression)
+            key = ResultStore.make_key(params)
+            if not logs:
+                with stage('result_store'):
+                    stored = self.result_store.get(key)
+
+        if stored is not None:
+            self.result = BacktestResult.from_store(*stored)
+        else:
+            start = time.perf_counter()
+            self.result = self.backtest(cash, commission, tf, compression, engine, block_size)
+            if self.result_store is not None:
+                self.result_store.put(key, params, *self.result.to_store(time.perf_counter() - start))
+        self.final_value = self.result.final_value
+        self.stability = self.result.stability
+        self.recording = self.result.recording
+
+        if self.output_settings['performance']:
+            print('Final Portfolio Value: %.2f' % self.final_value)
+
+        # The dataframe of the returns is made only for the reports
+        if self.output_settings['performance'] or self.output_settings['plot']:
+            df_returns = self.result.returns.to_frame()
+
+        if self.output_settings['performance']:
+            import pyfolio as pf
+            print('Performance:')
+            print('Return: ' + str((self.final_value - cash) / cash * 100) + '%')
+            print('Stability:' + str(self.stability))
+            print('Top-5 Drawdowns:')
+            with stage('drawdown_table'):
+                drawdowns = pf.show_worst_drawdown_periods(df_returns['return'], top=5)
+            print(drawdowns)
+
+        if self.output_settings['plot']:
+            with stage('plots'):
+                import matplotlib.pyplot as plt
+                import pyfolio as pf
+                import seaborn as sns
+                sns.set_style("whitegrid")
+
+                # Take Close prices of the candles and calculate the returns as a benchmark
+                capital_algo = np.cumprod(1.0 + df_returns['return']) * cash
+                benchmark_returns = pd.Series(self.candles.close[self.bars]).pct_change()
+                capital_benchmark = np.cumprod(1.0 + benchmark_returns) * cash
+                df_returns['benchmark_return'] = benchmark_returns
+
+                # Plot Capital Curves
+                plt.figure(figsize=(12, 7))
+                plt.plot(np.array(capital_algo), color='blue')
+                plt.plot(np.array(capital_benchmark), color='red')
+                plt.legend(['Algorithm', 'Buy & Hold'])
+                plt.title('Capital Curve')
+                plt.xlabel('Time')
+                plt.ylabel('Value')
+                plt.show()
+
+                # Plot Drawdown Underwater
+                plt.figure(figsize=(12, 7))
+                pf.plot_drawdown_underwater(df_returns['return']).set_xlabel('Time')
+                plt.show()
+
+                # Plot Top-5 Drawdowns
+                plt.figure(figsize=(12, 7))
+                pf.plot_drawdown_periods(df_returns['return'], top=5).set_xlabel('Time')
+                plt.show()
+
+                # Plot Simple Returns
+                plt.figure(figsize=(12, 7))
+                plt.plot(df_returns['return'], 'blue')
+                plt.title('Returns')
+                plt.xlabel('Time')
+                plt.ylabel('Return')
+                plt.show()
 
-    def run_strategy(self, cash=1000, commission=0.0004, tf=bt.TimeFrame.Minutes, compression=60):
+                # Plot Return Quantiles by Timeframe
+                plt.figure(figsize=(12, 7))
+                pf.plot_return_quantiles(df_returns['return']).set_xlabel('Timeframe')
+                plt.show()
+
+                # Plot Monthly Returns Dist
+                plt.figure(figsize=(12, 7))
+                pf.plot_monthly_returns_dist(df_returns['return']).set_xlabel('Returns')
+                plt.show()
+
+        return self.result
+
+    # Series of the returns of the last run
+    @property
+    def returns(self):
+        return self.result.returns
+
+    # Run the strategy on the engine, returns BacktestResult
+    def backtest(self, cash, commission, tf, compression, engine, block_size):
+        self.recording = None
+        if engine == 'chunked':
+            equity = self.run_chunked(cash, commission, tf, compression, block_size)
+        else:
+            if engine == 'fast':
+                timestamps, values = self.run_fast(cash, commission)
+            else:
+                timestamps, values = self.run_cerebro(cash, commission, tf, compression)
+            with stage('returns'):
+                equity = EquityStream(cash, tf, compression)
+                equity.add(timestamps, values)
+
+        return self.equity_result(equity, cash, tf, compression, self.recording)
+
+    # BacktestResult of the values of EquityStream
+    def equity_result(self, equity, cash, tf, compression, recording=None):
+        if not equity.keep_returns:
+            return BacktestResult(equity.final_value, (equity.final_value - cash) / cash, equity.stability(),
+                                  None, None, equity.max_drawdown, recording)
+        end_timestamps, returns = equity.finish()
+        return BacktestResult(equity.final_value, (equity.final_value - cash) / cash,
+                              self.stability_of_timeseries(returns), period_keys(end_timestamps, tf, compression),
+                              returns, equity.max_drawdown, recording)
+
+    # Run the strategy in cerebro, returns the timestamps of the bars and the portfolio values at them.
+    # The orders and the trades recorded by EquityRecorder are kept in self.recording
+    @staged('cerebro')
+    def run_cerebro(self, cash, commission, tf, compression):
         cerebro = bt.Cerebro()
+        cerebro.broker = InstrumentedBroker()
         cerebro.broker.setcommission(commission=commission)
         cerebro.broker.setcash(cash)
 
-        data = FinamHLOC(dataname=self.file_data, timeframe=tf, compression=compression)
+        # The bars before the window warm up the indicator: its history and the pivot window before the first bar
+        trade_start = 0
+        candles = self.candles
+        if self.window is not None:
+            start, stop, _ = self.bars.indices(len(self.candles))
+            first = max(start - int(self.algo_params['pivot_window_len']) *
+                        (int(self.algo_params['history_bars_as_multiple_pwl']) + 1), 0)
+            trade_start = start - first
+            candles = self.candles.slice(first, stop)
+        data = FinamArrays(dataname=candles, timeframe=tf, compression=compression)
 
-        cerebro.addanalyzer(bt.analyzers.TimeReturn, _name='returns')
+        cerebro.addanalyzer(EquityRecorder, _name='recorder', start=trade_start)
         cerebro.adddata(data)
         cerebro.addstrategy(TrendBreakerPL,
                             pivot_window_len=self.algo_params['pivot_window_len'],
@@ -35,77 +281,178 @@ class BacktestTrendBreakerPL:
                             fixed_sl_as_multiple_tp=self.algo_params['fixed_sl_as_multiple_tp'],
                             order_full=self.output_settings['order_full'],
                             order_status=self.output_settings['order_status'],
-                            trades=self.output_settings['trades'])
-
-        if self.output_settings['performance']:
-            print('Starting Portfolio Value: %.2f' % cerebro.broker.getvalue())
+                            trades=self.output_settings['trades'],
+                            indicator_cache=self.indicator_cache,
+                            trade_start=trade_start)
         strats = cerebro.run()
         first_strat = strats[0]
 
-        if self.output_settings['performance']:
-            print('Final Portfolio Value: %.2f' % cerebro.broker.getvalue())
+        self.recording = first_strat.analyzers.getbyname('recorder').get_analysis()
+        return self.recording['timestamp'], self.recording['value']
 
-        od_returns = first_strat.analyzers.getbyname('returns').get_analysis()
-        df_returns = pd.DataFrame(od_returns.items(), columns=['date', 'return'])
-        df_returns = df_returns.set_index('date')
+    # Run the strategy with FastSimulator on the arrays of the indicator, returns the same as run_cerebro
+    @staged('fast')
+    def run_fast(self, cash, commission):
+        candles = self.candles
+        direction = pivot_point_line_lines(candles.open, candles.high, candles.low, candles.close,
+                                           pivot_window_len=self.algo_params['pivot_window_len'],
+                                           history_bars_as_multiple_pwl=self.algo_params['history_bars_as_multiple_pwl'],
+                                           cache=self.indicator_cache,
+                                           fingerprint=candles.fingerprint)[3]
+        bars = self.bars
+        with stage('simulation'):
+            values, _, _ = simulate(candles.open[bars], candles.high[bars], candles.low[bars], candles.close[bars],
+                                    direction[bars],
+                                    fixed_tp=self.algo_params['fixed_tp'],
+                                    fixed_sl_as_multiple_tp=self.algo_params['fixed_sl_as_multiple_tp'],
+                                    cash=cash,
+                                    commission=commission)
 
-        self.stability = self.stability_of_timeseries(df_returns['return'])
+        return np.asarray(candles.timestamp[bars]), values
 
-        if self.output_settings['performance']:
-            print('Performance:')
-            print('Return: ' + str((cerebro.broker.getvalue() - cash) / cash * 100) + '%')
-            print('Stability:' + str(self.stability))
-            print('Top-5 Drawdowns:')
-            print(pf.show_worst_drawdown_periods(df_returns['return'], top=5))
+    # Run the strategy with FastSimulator on the candles in blocks, the indicator carries the tail of its history over
+    # the blocks (see pivot_point_line_blocks), the simulation carries its state. The own candles of file_data are read
+    # from the cache, so the memory is bounded by the block size whatever the length of the file, the other candles
+    # (e.g. resampled) are sliced in memory. The metrics are the same as run_fast's.
+    # Returns EquityStream of the values, it keeps only the running metrics of the returns.
+    @staged('chunked')
+    def run_chunked(self, cash, commission, tf, compression, block_size):
+        pivot_window_len = int(self.algo_params['pivot_window_len'])
+        history_bars_as_multiple_pwl = int(self.algo_params['history_bars_as_multiple_pwl'])
+        start, stop, _ = self.bars.indices(len(self.candles))
+        # The indicator of the first traded bar needs the history and the pivot window before it
+        first = max(start - pivot_window_len * (history_bars_as_multiple_pwl + 1), 0)
 
-        if self.output_settings['plot']:
-            # Read Close prices from csv and calculate the returns as a benchmark
-            capital_algo = np.cumprod(1.0 + df_returns['return']) * cash
-            benchmark_df = pd.read_csv(self.file_data)
-            benchmark_returns = benchmark_df['<CLOSE>'].pct_change()
-            capital_benchmark = np.cumprod(1.0 + benchmark_returns) * cash
-            df_returns['benchmark_return'] = benchmark_returns
-
-            # Plot Capital Curves
-            plt.figure(figsize=(12, 7))
-            plt.plot(np.array(capital_algo), color='blue')
-            plt.plot(np.array(capital_benchmark), color='red')
-            plt.legend(['Algorithm', 'Buy & Hold'])
-            plt.title('Capital Curve')
-            plt.xlabel('Time')
-            plt.ylabel('Value')
-            plt.show()
-
-            # Plot Drawdown Underwater
-            plt.figure(figsize=(12, 7))
-            pf.plot_drawdown_underwater(df_returns['return']).set_xlabel('Time')
-            plt.show()
-
-            # Plot Top-5 Drawdowns
-            plt.figure(figsize=(12, 7))
-            pf.plot_drawdown_periods(df_returns['return'], top=5).set_xlabel('Time')
-            plt.show()
-
-            # Plot Simple Returns
-            plt.figure(figsize=(12, 7))
-            plt.plot(df_returns['return'], 'blue')
-            plt.title('Returns')
-            plt.xlabel('Time')
-            plt.ylabel('Return')
-            plt.show()
-
-            # Plot Return Quantiles by Timeframe
-            plt.figure(figsize=(12, 7))
-            pf.plot_return_quantiles(df_returns['return']).set_xlabel('Timeframe')
-            plt.show()
-
-            # Plot Monthly Returns Dist
-            plt.figure(figsize=(12, 7))
-            pf.plot_monthly_returns_dist(df_returns['return']).set_xlabel('Returns')
-            plt.show()
+        # The candles read but not simulated yet: the indicator yields the bars pivot_window_len bars later
+        pending = {'timestamp': np.empty(0, dtype=np.int64), 'open': np.empty(0), 'high': np.empty(0),
+                   'low': np.empty(0), 'close': np.empty(0)}
+
+        if self.candles.fingerprint == finam_cache(self.candles.file_data)[1]['sha1']:
+            blocks = read_candle_blocks(self.candles.file_data, block_size, first, stop)
+        else:
+            blocks = (self.candles.slice(i, min(i + block_size, stop)) for i in range(first, stop, block_size))
+
+        def indicator_blocks():
+            for candles in blocks:
+                for name in pending:
+                    pending[name] = np.concatenate((pending[name], getattr(candles, name)))
+                yield candles.open, candles.high, candles.low, candles.close
+
+        simulation = BatchSimulation(*[np.empty(0)] * 5,
+                                     fixed_tp=[self.algo_params['fixed_tp']],
+                                     fixed_sl_as_multiple_tp=[self.algo_params['fixed_sl_as_multiple_tp']],
+                                     cash=cash,
+                                     commission=commission)
+        equity = EquityStream(cash, tf, compression, keep_returns=False)
+        for bar, outputs in pivot_point_line_blocks(indicator_blocks(), pivot_window_len, history_bars_as_multiple_pwl):
+            count = len(outputs[3])
+            block = {name: values[:count] for name, values in pending.items()}
+            for name in pending:
+                pending[name] = pending[name][count:]
+
+            # Skip the warm-up bars of the indicator
+            skip = min(max(start - first - bar, 0), count)
+            with stage('simulation'):
+                values = simulation.run_block(block['open'][skip:], block['high'][skip:], block['low'][skip:],
+                                              block['close'][skip:], outputs[3][skip:])[0]
+            equity.add(block['timestamp'][skip:], values)
+
+        return equity
+
+    # Run the strategy with FastSimulator for every row of param_matrix: pivot_window_len,
+    # history_bars_as_multiple_pwl, fixed_tp and fixed_sl_as_multiple_tp (algo_params aren't used).
+    # The indicator is calculated once for the rows with the same integer params of it, TP & SL of these rows are
+    # simulated together in one pass over the candles. Returns the arrays of the stabilities and the total returns.
+    # With Pruner the hopeless rows are stopped at its checkpoints and get the penalized stability and the return
+    # at the checkpoint, self.pruned marks them.
+    # With the result store the rows stored before aren't simulated, the completed rows are stored as the runs of
+    # the fast engine (the same results, no orders and trades are recorded). The pruned rows aren't stored.
+    @instrumented
+    def run_batch(self, param_matrix, cash=1000, commission=0.0004, tf=bt.TimeFrame.Minutes, compression=60,
+                  pruner=None):
+        candles = self.candles
+        bars = self.bars
+        param_matrix = np.atleast_2d(np.asarray(param_matrix, dtype=float))
+        indicator_params = param_matrix[:, :2].astype(int)
+        ids = period_ids(candles.timestamp[bars], tf, compression)
+        num_bars = len(ids)
+        stops = (pruner.checkpoint_bars(num_bars) if pruner is not None else []) + [num_bars]
 
+        stabilities = np.full(len(param_matrix), np.nan)
+        returns = np.full(len(param_matrix), np.nan)
+        self.pruned = np.zeros(len(param_matrix), dtype=bool)
+        todo = np.arange(len(param_matrix))
+        keys = {}
+        if self.result_store is not None:
+            with stage('result_store'):
+                for row, params in enumerate(param_matrix):
+                    algo_params = dict(zip(['pivot_window_len', 'history_bars_as_multiple_pwl', 'fixed_tp',
+                                            'fixed_sl_as_multiple_tp'], params))
+                    run_params = ResultStore.make_params(candles, self.window, 'fast', algo_params,
+                                                         cash, commission, tf, compression)
+                    keys[row] = ResultStore.make_key(run_params), run_params
+                    stored = self.result_store.get(keys[row][0])
+                    if stored is not None:
+                        stabilities[row] = stored[0]['stability']
+                        returns[row] = stored[0]['total_return']
+            todo = np.flatnonzero(np.isnan(returns))
+
+        groups, group_ind = np.unique(indicator_params[todo], axis=0, return_inverse=True)
+        for i, (pivot_window_len, history_bars_as_multiple_pwl) in enumerate(groups):
+            rows = todo[group_ind.ravel() == i]
+            group_start = time.perf_counter()
+            direction = pivot_point_line_lines(candles.open, candles.high, candles.low, candles.close,
+                                               pivot_window_len=pivot_window_len,
+                                               history_bars_as_multiple_pwl=history_bars_as_multiple_pwl,
+                                               cache=self.indicator_cache,
+                                               fingerprint=candles.fingerprint)[3]
+            simulation = BatchSimulation(candles.open[bars], candles.high[bars], candles.low[bars], candles.close[bars],
+                                         direction[bars],
+                                         fixed_tp=param_matrix[rows, 2],
+                                         fixed_sl_as_multiple_tp=param_matrix[rows, 3],
+                                         cash=cash,
+                                         commission=commission)
+            for stop in stops:
+                start = time.perf_counter()
+                with stage('simulation'):
+                    values = simulation.run(stop)
+                if pruner is not None:
+                    pruner.count_time(time.perf_counter() - start)
+                if stop == num_bars:
+                    break
+
+                # Check the equity curves at the checkpoint
+                keep = np.ones(len(simulation.rows), dtype=bool)
+                drawdowns = max_drawdown(values[:, :stop], cash)
+                for j, row in enumerate(rows[simulation.rows]):
+                    stability = self.stability_of_timeseries(period_returns(values[j, :stop], ids[:stop], cash)[1])
+                    if pruner.check(stability, drawdowns[j]):
+                        keep[j] = False
+                        self.pruned[row] = True
+                        stabilities[row] = pruner.penalized(stability)
+                        returns[row] = (values[j, stop - 1] - cash) / cash
+                        pruner.count(True, stop, num_bars - stop)
+                simulation.keep(keep)
+
+            for row, row_values in zip(rows[simulation.rows], values):
+                stabilities[row] = self.stability_of_timeseries(period_returns(row_values, ids, cash)[1])
+                returns[row] = ((row_values[-1] if len(row_values) > 0 else cash) - cash) / cash
+                if pruner is not None:
+                    pruner.count(False, num_bars, 0)
+
+            if self.result_store is not None:
+                runtime = (time.perf_counter() - group_start) / len(rows)
+                with stage('result_store'):
+                    for row, row_values in zip(rows[simulation.rows], values):
+                        equity = EquityStream(cash, tf, compression)
+                        equity.add(candles.timestamp[bars], row_values)
+                        self.result_store.put(*keys[row], *self.equity_result(equity, cash, tf, compression)
+                                              .to_store(runtime))
+
+        return stabilities, returns
 
     # Determines R-squared of a linear fit to the cumulative log returns. Negative value means unprofitable result.
+    @staged('stability')
     def stability_of_timeseries(self, returns):
         if len(returns) < 2:
             return np.nan
@@ -114,10 +461,15 @@ class BacktestTrendBreakerPL:
         returns = returns[~np.isnan(returns)]
 
         cum_log_returns = np.log1p(returns).cumsum()
-        rhat = stats.linregress(np.arange(len(cum_log_returns)),
-                                cum_log_returns)[2]
+        rhat = correlation(np.arange(len(cum_log_returns)), cum_log_returns)
 
         if cum_log_returns[0] < cum_log_returns[-1]:
             return rhat ** 2
         else:
-            return -(rhat ** 2)
\ No newline at end of file
+            return -(rhat ** 2)
+
+
+# Pearson correlation coefficient, calculated exactly as the r-value of scipy.stats.linregress
+def correlation(x, y):
+    ssxm, ssxym, _, ssym = np.cov(x, y, bias=1).flat
+    return correlation_of_covariance(ssxm, ssxym, ssym)
@@ -0,0 +1,50 @@
+from BacktestTrendBreakerPL import BacktestTrendBreakerPL
+from DataCache import load_finam_candles
+from FastSimulator import warm_up
+import backtrader as bt
+import warnings
+
+# Output settings of the backtests run by the optimizers and the grids: nothing is printed or plotted
+HEADLESS_OUTPUT = {'order_full': False,
+                   'order_status': False,
+                   'trades': False,
+                   'performance': False,
+                   'plot': False
+                   }
+
+# Candles and the indicator cache of the worker process, the candles are memory-mapped once per worker
+worker_candles = None
+worker_indicator_cache = None
+
+
+# Initialization of the worker process running the backtests: the candles of file_data (None if the worker loads
+# them per task) and IndicatorCache shared by its backtests. The simulation is compiled once with jit.
+def init_backtest_worker(file_data=None, indicator_cache=None, jit=True):
+    global worker_candles, worker_indicator_cache
+    warnings.filterwarnings("ignore")
+    worker_candles = load_finam_candles(file_data) if file_data is not None else None
+    worker_indicator_cache = indicator_cache
+    if jit:
+        warm_up()
+
+
+# Backtest of the candles of the worker (or the given ones) with the indicator cache of the worker
+def worker_backtest(algo_params=None, candles=None, window=None, **kwargs):
+    candles = candles if candles is not None else worker_candles
+    return BacktestTrendBreakerPL(file_data=candles.file_data, algo_params=algo_params,
+                                  output_settings=HEADLESS_OUTPUT, candles=candles,
+                                  indicator_cache=worker_indicator_cache, window=window, **kwargs)
+
+
+# Objective of the swarm for SwarmOptimizer(batch=True): minus the stabilities of the positions by run_batch.
+# The stabilities, the returns and the pruned flags (all False without the pruner) are the extra results of the
+# journal.
+class BatchObjective:
+    def __init__(self, backtest, cash=1000, commission=0.0004, tf=bt.TimeFrame.Minutes, compression=60, pruner=None):
+        self.backtest = backtest
+        self.settings = {'cash': cash, 'commission': commission, 'tf': tf, 'compression': compression}
+        self.pruner = pruner
+
+    def __call__(self, positions):
+        stabilities, returns = self.backtest.run_batch(positions, pruner=self.pruner, **self.settings)
+        return -stabilities, {'stability': stabilities, 'return': returns, 'pruned': self.backtest.pruned}
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import numpy as np
+import backtrader as bt
+from DataFeedFormat import read_finam_csv_blocks
+from FastSimulator import period_ids
+from Instrumentation import staged
+
+# Columns of the binary cache: the candle time, the same time as backtrader float number and OHLCV
+CACHE_COLUMNS = ('timestamp', 'datetime', 'open', 'high', 'low', 'close', 'volume')
+CACHE_DTYPES = {'timestamp': np.int64, 'datetime': np.float64, 'open': np.float64, 'high': np.float64,
+                'low': np.float64, 'close': np.float64, 'volume': np.float64}
+CACHE_VERSION = 1
+# Rows of the csv parsed at once and bars of the cache read at once by the out-of-core path
+BLOCK_SIZE = 1 << 17
+
+
+# SHA-1 of the file content
+def file_sha1(file_data, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(file_data, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# Candles of the Finam csv as the columns of numpy arrays (memory-mapped from the cache files)
+class FinamCandles:
+    def __init__(self, file_data, fingerprint, columns):
+        self.file_data = file_data
+        # SHA-1 of the csv, identifies the dataset
+        self.fingerprint = fingerprint
+        self.timestamp = columns['timestamp']    # int64, nanoseconds since epoch
+        self.datetime = columns['datetime']      # float64, backtrader date number
+        self.open = columns['open']
+        self.high = columns['high']
+        self.low = columns['low']
+        self.close = columns['close']
+        self.volume = columns['volume']
+
+    def __len__(self):
+        return len(self.close)
+
+    # Candles of the bars [start, stop) without copying the arrays
+    def slice(self, start, stop):
+        columns = {name: getattr(self, name)[start:stop] for name in CACHE_COLUMNS}
+        return FinamCandles(self.file_data, '{0}[{1}:{2}]'.format(self.fingerprint, start, stop), columns)
+
+
+# Parse the Finam csv once and store it to the cache directory as one .npy file per column.
+# The cache is valid while size and mtime of the csv don't change, if they do, SHA-1 of the content decides.
+# Columns are memory-mapped, so all processes using the same cache share one physical copy of the data.
+@staged('load_candles')
+def load_finam_candles(file_data, cache_dir='./cache'):
+    path, meta = finam_cache(file_data, cache_dir)
+    columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in CACHE_COLUMNS}
+    return FinamCandles(file_data, meta['sha1'], columns)
+
+
+# The candles of the bars [start, stop) of the csv in the blocks of block_size bars (the last one can be shorter).
+# The blocks are read from the cache files, not memory-mapped, so the memory is bounded by the block size
+# whatever the length of the file.
+def read_candle_blocks(file_data, block_size=BLOCK_SIZE, start=0, stop=None, cache_dir='./cache'):
+    path, meta = finam_cache(file_data, cache_dir)
+    stop = meta['length'] if stop is None else min(stop, meta['length'])
+    files = {name: open(os.path.join(path, name + '.npy'), 'rb') for name in CACHE_COLUMNS}
+    try:
+        dtypes = {}
+        for name, f in files.items():
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                np.lib.format.read_array_header_2_0
+            _, _, dtypes[name] = read_header(f)
+            f.seek(start * dtypes[name].itemsize, os.SEEK_CUR)
+
+        for block_start in range(start, stop, block_size):
+            count = min(block_size, stop - block_start)
+            columns = {name: np.fromfile(f, dtype=dtypes[name], count=count) for name, f in files.items()}
+            yield FinamCandles(file_data, '{0}[{1}:{2}]'.format(meta['sha1'], block_start, block_start + count),
+                               columns)
+    finally:
+        for f in files.values():
+            f.close()
+
+
+# Directory and meta of the valid cache of the csv, the cache is built if there is none
+def finam_cache(file_data, cache_dir='./cache'):
+    stat = os.stat(file_data)
+    path = os.path.join(cache_dir, os.path.basename(file_data) + '.cache')
+    meta_file = os.path.join(path, 'meta.json')
+
+    meta = None
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION:
+            meta = None
+        elif meta['size'] != stat.st_size or meta['mtime_ns'] != stat.st_mtime_ns:
+            # The file is touched or changed, keep the cache if the content is the same
+            if meta['size'] == stat.st_size and meta['sha1'] == file_sha1(file_data):
+                meta['mtime_ns'] = stat.st_mtime_ns
+                write_json(meta_file, meta)
+            else:
+                meta = None
+
+    if meta is None:
+        meta = build_cache(file_data, path, stat)
+
+    return path, meta
+
+
+# The csv is parsed in blocks and every block is appended to the .npy files, the header of the files is written
+# with the number of the rows at the end
+@staged('parse_csv')
+def build_cache(file_data, path, stat, block_size=BLOCK_SIZE):
+    os.makedirs(path, exist_ok=True)
+    tmp_files = {name: os.path.join(path, '{0}.{1}.tmp.npy'.format(name, os.getpid())) for name in CACHE_COLUMNS}
+    files = {name: open(tmp_file, 'wb') for name, tmp_file in tmp_files.items()}
+    length = 0
+    try:
+        offsets = {name: write_npy_header(f, CACHE_DTYPES[name], 0) for name, f in files.items()}
+        for df in read_finam_csv_blocks(file_data, block_size):
+            for name, values in finam_columns(df).items():
+                files[name].write(values.astype(CACHE_DTYPES[name]).tobytes())
+            length += len(df)
+
+        # numpy pads the header for growing the array in place, so the final one takes the same room
+        for name, f in files.items():
+            if write_npy_header(f, CACHE_DTYPES[name], length) != offsets[name]:
+                raise RuntimeError('The header of {0} doesn\'t fit the room for it'.format(tmp_files[name]))
+    finally:
+        for f in files.values():
+            f.close()
+
+    # Rename, so the concurrent readers never see the partial file
+    for name, tmp_file in tmp_files.items():
+        os.replace(tmp_file, os.path.join(path, name + '.npy'))
+
+    # Meta is written the last and marks the cache as valid
+    meta = {'version': CACHE_VERSION,
+            'file': os.path.abspath(file_data),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha1': file_sha1(file_data),
+            'length': length}
+    write_json(os.path.join(path, 'meta.json'), meta)
+    return meta
+
+
+# Write the header of the .npy file of the 1-d array at the beginning of the file, returns the offset of the data
+def write_npy_header(f, dtype, length):
+    f.seek(0)
+    np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                             'fortran_order': False,
+                                             'shape': (length,)})
+    return f.tell()
+
+
+# Columns of the cache for the dataframe of read_finam_csv
+def finam_columns(df):
+    return {'timestamp': df.index.values.astype(np.int64),
+            'datetime': np.array([bt.date2num(dt) for dt in df.index.to_pydatetime()]),
+            'open': df['<OPEN>'].values.astype(float),
+            'high': df['<HIGH>'].values.astype(float),
+            'low': df['<LOW>'].values.astype(float),
+            'close': df['<CLOSE>'].values.astype(float),
+            'volume': df['<VOL>'].values.astype(float)}
+
+
+def write_json(file_name, obj):
+    tmp_file = '{0}.{1}.tmp'.format(file_name, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_file, file_name)
+
+
+# Candles of the higher timeframe made of the candles in memory: the bars within one period of the timeframe
+# (the same periods as TimeReturn analyzer) are joined, the time of the new bar is the time of its first bar.
+# If every period has one bar, the same candles are returned.
+def resample_candles(candles, tf, compression):
+    ids = period_ids(candles.timestamp, tf, compression)
+    starts = np.flatnonzero(np.concatenate(([True], np.diff(ids) != 0))) if len(ids) > 0 else np.empty(0, int)
+    if len(starts) == len(candles):
+        return candles
+
+    ends = np.append(starts[1:], len(candles)) - 1
+    columns = {'timestamp': np.asarray(candles.timestamp)[starts],
+               'datetime': np.asarray(candles.datetime)[starts],
+               'open': np.asarray(candles.open)[starts],
+               'high': np.maximum.reduceat(candles.high, starts),
+               'low': np.minimum.reduceat(candles.low, starts),
+               'close': np.asarray(candles.close)[ends],
+               'volume': np.add.reduceat(candles.volume, starts)}
+    return FinamCandles(candles.file_data, '{0}@{1}/{2}'.format(candles.fingerprint, tf, compression), columns)
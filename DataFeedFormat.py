@@ -1,4 +1,8 @@
+import backtrader as bt
 import backtrader.feeds as btfeed
+import numpy as np
+import pandas as pd
+from Instrumentation import staged
 
 
 class FinamHLOC(btfeed.GenericCSVData):
@@ -12,4 +16,63 @@ class FinamHLOC(btfeed.GenericCSVData):
         ('open', 4),
         ('close', 7),
         ('volume', 8)
-    )
\ No newline at end of file
+    )
+
+
+# The same Finam candles from the arrays of FinamCandles (see DataCache), the lines are filled in bulk on preload
+class FinamArrays(bt.feed.DataBase):
+    lines_arrays = ('datetime', 'open', 'high', 'low', 'close', 'volume')
+
+    def start(self):
+        super(FinamArrays, self).start()
+        self._ind = -1
+
+    @staged('data_feed')
+    def preload(self):
+        if self._filters or self._tzinput:
+            return super(FinamArrays, self).preload()
+
+        candles = self.p.dataname
+        datetime = np.asarray(candles.datetime)
+        selected = (datetime >= self.fromdate) & (datetime <= self.todate)
+        for name in self.lines_arrays:
+            values = np.asarray(getattr(candles, name))[selected]
+            getattr(self.lines, name).array.frombytes(values.astype(float).tobytes())
+        self.lines.openinterest.array.frombytes(np.full(np.count_nonzero(selected), np.nan).tobytes())
+        # All the candles are loaded, so the bar by bar mode (runonce=False) doesn't load them again with _load
+        # after the preloaded bars
+        self._ind = len(datetime)
+
+        self._last()
+        self.home()
+
+    def _load(self):
+        self._ind += 1
+        candles = self.p.dataname
+        if self._ind >= len(candles):
+            return False
+
+        for name in self.lines_arrays:
+            getattr(self.lines, name)[0] = getattr(candles, name)[self._ind]
+        return True
+
+
+# Read the Finam csv into the dataframe indexed by the candle datetime
+# Prices are parsed with 'round_trip' precision to get exactly the same floats as FinamHLOC
+def read_finam_csv(file_data):
+    df = pd.read_csv(file_data, dtype={'<DATE>': str, '<TIME>': str}, float_precision='round_trip')
+    return index_finam_candles(df)
+
+
+# The same dataframes for the blocks of block_size rows of the csv, the file is never read into memory as a whole
+def read_finam_csv_blocks(file_data, block_size):
+    with pd.read_csv(file_data, dtype={'<DATE>': str, '<TIME>': str}, float_precision='round_trip',
+                     chunksize=block_size) as reader:
+        for df in reader:
+            yield index_finam_candles(df)
+
+
+def index_finam_candles(df):
+    df.index = pd.to_datetime(df['<DATE>'] + df['<TIME>'].str.zfill(6), format='%Y%m%d%H%M%S')
+    df.index.name = 'datetime'
+    return df
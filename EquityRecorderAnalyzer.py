@@ -0,0 +1,85 @@
+import backtrader as bt
+import numpy as np
+from Instrumentation import staged
+
+# backtrader's date number of 1970-01-01
+EPOCH_DATE_NUM = 719163.0
+
+
+# Timestamps (int64 nanoseconds since epoch) of backtrader's date numbers, the same datetimes as num2date gives
+def date_nums_to_timestamps(date_nums):
+    date_nums = np.asarray(date_nums, dtype=float)
+    days = np.floor(date_nums)
+    hours, remainder = np.divmod(24.0 * (date_nums - days), 1.0)
+    minutes, remainder = np.divmod(60.0 * remainder, 1.0)
+    seconds, remainder = np.divmod(60.0 * remainder, 1.0)
+    microseconds = np.floor(1e6 * remainder)
+    # num2date compensates for the rounding errors by these rules
+    microseconds[microseconds < 10] = 0.0
+    microseconds[microseconds > 999990] = 1e6
+    total = ((days - EPOCH_DATE_NUM) * 86400 + hours * 3600 + minutes * 60 + seconds) * 10 ** 6 + microseconds
+    return total.astype(np.int64) * 1000
+
+
+# Columns of numpy arrays filled row by row, the capacity is doubled when it's exceeded
+class RecordArrays:
+    def __init__(self, capacity, **dtypes):
+        self.size = 0
+        self.arrays = {name: np.empty(max(capacity, 1), dtype=dtype) for name, dtype in dtypes.items()}
+
+    def append(self, *values):
+        if self.size == len(next(iter(self.arrays.values()))):
+            self.arrays = {name: np.concatenate((array, np.empty_like(array))) for name, array in self.arrays.items()}
+        for array, value in zip(self.arrays.values(), values):
+            array[self.size] = value
+        self.size += 1
+
+    def to_dict(self, prefix=''):
+        return {prefix + name: array[:self.size] for name, array in self.arrays.items()}
+
+
+# Records the backtest into preallocated numpy arrays instead of the dict of datetimes like TimeReturn: the time,
+# the portfolio value (the same one as TimeReturn takes), the cash and the position size at every bar, the fills
+# of the orders and the closed trades. The bar arrays are sized by the preloaded data.
+# get_analysis returns the arrays: timestamp, value, cash, position, fill_bar, fill_size, fill_price,
+# fill_commission, trade_bar, trade_pnl and trade_pnlcomm (the bars are the indices of the bar arrays).
+# The bars before the start (e.g. the warm-up of the indicator) aren't recorded.
+class EquityRecorder(bt.Analyzer):
+    params = (
+        ('start', 0),
+    )
+
+    def start(self):
+        self.bars = RecordArrays(self.strategy.data.buflen(), datetime=np.float64, value=np.float64,
+                                 cash=np.float64, position=np.float64)
+        self.fills = RecordArrays(64, bar=np.int64, size=np.float64, price=np.float64, commission=np.float64)
+        self.trades = RecordArrays(64, bar=np.int64, pnl=np.float64, pnlcomm=np.float64)
+        self.fund_cash = self.strategy.broker.getcash()
+        self.fund_value = self.strategy.broker.getvalue()
+
+    @staged('analyzer')
+    def notify_fund(self, cash, value, fundvalue, shares):
+        self.fund_cash = cash
+        self.fund_value = value
+
+    # The orders and the trades are notified before next of the bar
+    def notify_order(self, order):
+        if order.status == order.Completed:
+            self.fills.append(self.bars.size, order.executed.size, order.executed.price, order.executed.comm)
+
+    def notify_trade(self, trade):
+        if trade.isclosed:
+            self.trades.append(self.bars.size, trade.pnl, trade.pnlcomm)
+
+    @staged('analyzer')
+    def next(self):
+        if len(self.strategy) <= self.params.start:
+            return
+        self.bars.append(self.strategy.datetime[0], self.fund_value, self.fund_cash, self.strategy.position.size)
+
+    def get_analysis(self):
+        analysis = self.bars.to_dict()
+        analysis['timestamp'] = date_nums_to_timestamps(analysis.pop('datetime'))
+        analysis.update(self.fills.to_dict('fill_'))
+        analysis.update(self.trades.to_dict('trade_'))
+        return analysis
@@ -0,0 +1,90 @@
+import json
+import pickle
+import sqlite3
+import time
+import numpy as np
+
+
+# On-disk journal of the optimization in SQLite: every evaluation of the objective (the position, the objective value,
+# extra results of the backtest and its CPU time) and the checkpoint of the swarm state of the last iteration.
+# Only the main process of the optimizer writes to it, every write is committed at once, so the journal survives
+# the crash or the interruption of the run.
+class EvaluationJournal:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS evaluations ('
+                                    'key TEXT PRIMARY KEY, '
+                                    'position TEXT, '
+                                    'objective REAL, '
+                                    'info TEXT, '
+                                    'runtime REAL, '
+                                    'iteration INTEGER, '
+                                    'created REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints ('
+                                    'name TEXT PRIMARY KEY, '
+                                    'config TEXT, '
+                                    'state BLOB, '
+                                    'created REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS settings ('
+                                    'name TEXT PRIMARY KEY, '
+                                    'value TEXT)')
+
+    # Key of the position: exact hex representation of the floats, so only the same vector matches
+    @staticmethod
+    def make_key(position):
+        return ','.join(float(value).hex() for value in position)
+
+    # Known evaluations of the keys as {key: (objective, info)}
+    def lookup(self, keys):
+        known = {}
+        keys = list(keys)
+        # Stay below the SQLite limit of the query parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.connection.execute('SELECT key, objective, info FROM evaluations WHERE key IN ({0})'.format(
+                ','.join('?' * len(chunk))), chunk)
+            for key, objective, info in rows:
+                # SQLite stores NaN as NULL
+                known[key] = (np.nan if objective is None else objective, json.loads(info))
+        return known
+
+    # Append the evaluations: rows of (key, position, objective, info, runtime)
+    def append(self, rows, iteration):
+        created = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO evaluations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        [(key, json.dumps([float(value) for value in position]), float(objective),
+                                          json.dumps(info), runtime, iteration, created)
+                                         for key, position, objective, info, runtime in rows])
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM evaluations').fetchone()[0]
+
+    # Store the state of the optimizer, it replaces the previous checkpoint of the same name
+    def save_checkpoint(self, config, state, name='swarm'):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)',
+                                    (name, json.dumps(config, sort_keys=True), pickle.dumps(state), time.time()))
+
+    # The state of the last checkpoint, None if there is no checkpoint or it's made with the other config
+    def load_checkpoint(self, config, name='swarm'):
+        row = self.connection.execute('SELECT config, state FROM checkpoints WHERE name = ?', (name,)).fetchone()
+        if row is None or row[0] != json.dumps(config, sort_keys=True):
+            return None
+        return pickle.loads(row[1])
+
+    # Check the settings of the objective (e.g. the pruning) against the ones the journal is made with: the evaluations
+    # of the other settings aren't comparable, so the journal can't be reused. The journal without them takes them.
+    def check_settings(self, settings, name='objective'):
+        value = json.dumps(settings, sort_keys=True)
+        row = self.connection.execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            with self.connection:
+                self.connection.execute('INSERT INTO settings VALUES (?, ?)', (name, value))
+            return True
+        return row[0] == value
+
+    def close(self):
+        self.connection.close()
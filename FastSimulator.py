@@ -0,0 +1,457 @@
+import numpy as np
+import backtrader as bt
+import copy
+
+# Numba is optional: the same loop runs compiled if it's installed and as plain Python otherwise
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+DAY_NS = 86400 * 10 ** 9
+
+
+# Update of the position by the executed size at the price, the same as backtrader's Position.update
+# Returns new size, new price, opened and closed parts of the size
+def update_position(pos_size, pos_price, size, price):
+    new_size = pos_size + size
+    if new_size == 0:
+        return new_size, 0.0, 0, size
+    elif pos_size == 0:
+        return new_size, price, size, 0
+    elif pos_size > 0:
+        if size > 0:
+            return new_size, (pos_price * pos_size + size * price) / new_size, size, 0
+        elif new_size > 0:
+            return new_size, pos_price, 0, size
+        return new_size, price, new_size, -pos_size
+    else:
+        if size < 0:
+            return new_size, (pos_price * pos_size + size * price) / new_size, size, 0
+        elif new_size < 0:
+            return new_size, pos_price, 0, size
+        return new_size, price, new_size, -pos_size
+
+
+# Check the orders created at the previous bar with the cash at their creation price (BackBroker's checksubmit),
+# the accepted orders are moved to the beginning of order_sizes, returns their number
+def check_orders(cash, pos_size, pos_price, order_sizes, order_prices, num_orders, commission):
+    num_accepted = 0
+    for i in range(num_orders):
+        size = order_sizes[i]
+        price = order_prices[i]
+        pos_size, pos_price, opened, closed = update_position(pos_size, pos_price, size, price)
+        if closed != 0:
+            cash += -closed * price
+            cash -= abs(closed) * commission * price
+        if opened != 0:
+            cash -= opened * price
+            cash -= abs(opened) * commission * price
+        if cash >= 0.0:
+            order_sizes[num_accepted] = size
+            num_accepted += 1
+
+    return num_accepted
+
+
+# Execute the accepted market orders at the open price, the opening part is rejected if the cash isn't enough
+# Returns the new cash, position size and price and the number of fills
+def execute_orders(cash, pos_size, pos_price, order_sizes, num_accepted, price, commission):
+    num_fills = 0
+    for i in range(num_accepted):
+        size = order_sizes[i]
+        new_size, new_price, opened, closed = update_position(pos_size, pos_price, size, price)
+        if closed != 0:
+            pnl = -closed * (price - pos_price) * 1.0
+            cash += -closed * pos_price + pnl
+            cash -= abs(closed) * commission * price
+        if opened != 0:
+            open_cash = cash - opened * price
+            open_cash -= abs(opened) * commission * price
+            if open_cash < 0.0:
+                opened = 0
+            else:
+                cash = open_cash
+        if closed + opened != 0:
+            pos_size, pos_price, _, _ = update_position(pos_size, pos_price, closed + opened, price)
+            num_fills += 1
+
+    return cash, pos_size, pos_price, num_fills
+
+
+# Portfolio value at the close price, calculated in the same order of operations as BackBroker
+def portfolio_value(cash, pos_size, pos_price, close):
+    if pos_size > 0:
+        unrealized = pos_size * (close - pos_price) * 1.0
+        return cash + ((0.0 + (pos_size * close - unrealized) / 1.0) + unrealized)
+    return cash + (0.0 + pos_size * close)
+
+
+# Logic of TrendBreakerPL.next: orders for the entry on the signal, TP & SL and the reverse signal close the position,
+# every one of them with the separate order. Returns the number of created orders.
+def strategy_orders(value, pos_size, pos_price, signal, high, low, close, fixed_tp, sl, order_sizes, order_prices):
+    num_orders = 0
+    if pos_size == 0:
+        target = 0.0
+        if signal == 1.0:
+            target = 1.0 * value
+        elif signal == -1.0:
+            target = -1.0 * value
+        if target > 0.0:
+            size = int(1.0 * ((target - 0.0) // close))
+        elif target < 0.0:
+            size = -int(1.0 * ((0.0 - target) // close))
+        else:
+            size = 0
+        if size != 0:
+            order_sizes[0] = size
+            order_prices[0] = close
+            num_orders = 1
+    else:
+        if pos_size > 0:
+            num_close = (pos_price * (1.0 + fixed_tp) < high) + (pos_price * (1.0 - sl) > low) + (signal == -1.0)
+        else:
+            num_close = (pos_price * (1.0 - fixed_tp) > low) + (pos_price * (1.0 + sl) < high) + (signal == 1.0)
+        for i in range(num_close):
+            order_sizes[i] = -pos_size
+            order_prices[i] = close
+        num_orders = num_close
+
+    return num_orders
+
+
+# Bar by bar simulation of TrendBreakerPL with backtrader's BackBroker rules: market orders are checked against
+# the cash at their creation close price (checksubmit), executed at the next bar open, the opening part is rejected
+# if the cash isn't enough, percentage commission is paid on both sides, short selling adds cash.
+# Returns the broker value at every bar, the final cash and the number of executed orders.
+def simulate_core(open, high, low, close, direction, fixed_tp, fixed_sl_as_multiple_tp, cash, commission):
+    n = len(close)
+    values = np.empty(n)
+    sl = fixed_tp * fixed_sl_as_multiple_tp
+    pos_size = 0
+    pos_price = 0.0
+    num_orders = 0
+    num_fills = 0
+    # Orders created at the previous bar: signed size and creation price (close)
+    order_sizes = [0, 0, 0]
+    order_prices = [0.0, 0.0, 0.0]
+
+    for t in range(n):
+        num_accepted = check_orders(cash, pos_size, pos_price, order_sizes, order_prices, num_orders, commission)
+        cash, pos_size, pos_price, fills = execute_orders(cash, pos_size, pos_price, order_sizes, num_accepted,
+                                                          open[t], commission)
+        num_fills += fills
+        values[t] = portfolio_value(cash, pos_size, pos_price, close[t])
+        num_orders = strategy_orders(values[t], pos_size, pos_price, direction[t], high[t], low[t], close[t],
+                                     fixed_tp, sl, order_sizes, order_prices)
+
+    return values, cash, num_fills
+
+
+# The same simulation for many pairs of TP & SL on the same indicator signal in one pass over the bars [start, stop),
+# the particles are updated one after another at every bar. The state of the particles (cash, position and orders)
+# is kept in the arrays, so the simulation can be continued from stop. Values are written to values[:, start:stop].
+def simulate_batch_core(open, high, low, close, direction, fixed_tp, fixed_sl_as_multiple_tp, commission, start, stop,
+                        cash, pos_size, pos_price, num_orders, order_sizes, order_prices, values):
+    m = len(fixed_tp)
+    sl = fixed_tp * fixed_sl_as_multiple_tp
+
+    for t in range(start, stop):
+        for k in range(m):
+            num_accepted = check_orders(cash[k], pos_size[k], pos_price[k], order_sizes[k], order_prices[k],
+                                        num_orders[k], commission)
+            cash[k], pos_size[k], pos_price[k], _ = execute_orders(cash[k], pos_size[k], pos_price[k],
+                                                                   order_sizes[k], num_accepted, open[t], commission)
+            values[k, t] = portfolio_value(cash[k], pos_size[k], pos_price[k], close[t])
+            num_orders[k] = strategy_orders(values[k, t], pos_size[k], pos_price[k], direction[t], high[t], low[t],
+                                            close[t], fixed_tp[k], sl[k], order_sizes[k], order_prices[k])
+
+
+# simulate_batch_core as plain Python: the particles are simulated one after another on the lists of the bars,
+# Python floats are much faster than numpy scalars in the loop (see simulate). The state is written back to the arrays.
+def simulate_batch_lists(open, high, low, close, direction, fixed_tp, fixed_sl_as_multiple_tp, commission, start,
+                         stop, cash, pos_size, pos_price, num_orders, order_sizes, order_prices, values):
+    open, high, low, close, direction = [bars[start:stop].tolist() for bars in (open, high, low, close, direction)]
+    sl = (fixed_tp * fixed_sl_as_multiple_tp).tolist()
+    for k in range(len(fixed_tp)):
+        k_cash, k_size, k_price, k_orders = float(cash[k]), float(pos_size[k]), float(pos_price[k]), int(num_orders[k])
+        k_sizes, k_prices = order_sizes[k].tolist(), order_prices[k].tolist()
+        k_values = [0.0] * (stop - start)
+        for t in range(stop - start):
+            num_accepted = check_orders(k_cash, k_size, k_price, k_sizes, k_prices, k_orders, commission)
+            k_cash, k_size, k_price, _ = execute_orders(k_cash, k_size, k_price, k_sizes, num_accepted, open[t],
+                                                        commission)
+            k_values[t] = portfolio_value(k_cash, k_size, k_price, close[t])
+            k_orders = strategy_orders(k_values[t], k_size, k_price, direction[t], high[t], low[t], close[t],
+                                       float(fixed_tp[k]), sl[k], k_sizes, k_prices)
+        cash[k], pos_size[k], pos_price[k], num_orders[k] = k_cash, k_size, k_price, k_orders
+        order_sizes[k], order_prices[k] = k_sizes, k_prices
+        values[k, start:stop] = k_values
+
+
+if njit is not None:
+    update_position = njit(cache=True)(update_position)
+    check_orders = njit(cache=True)(check_orders)
+    execute_orders = njit(cache=True)(execute_orders)
+    portfolio_value = njit(cache=True)(portfolio_value)
+    strategy_orders = njit(cache=True)(strategy_orders)
+    simulate_core_jit = njit(cache=True)(simulate_core)
+    simulate_batch_core_jit = njit(cache=True)(simulate_batch_core)
+else:
+    simulate_core_jit = None
+    simulate_batch_core_jit = None
+
+
+# Run the simulation, compiled if numba is available
+def simulate(open, high, low, close, direction, fixed_tp, fixed_sl_as_multiple_tp, cash=1000, commission=0.0004,
+             jit=True):
+    arrays = [np.ascontiguousarray(values, dtype=float) for values in (open, high, low, close, direction)]
+    if jit and simulate_core_jit is not None:
+        return simulate_core_jit(*arrays, float(fixed_tp), float(fixed_sl_as_multiple_tp),
+                                 float(cash), float(commission))
+
+    # Python floats are much faster than numpy scalars in the plain loop
+    return simulate_core(*[values.tolist() for values in arrays], fixed_tp, fixed_sl_as_multiple_tp,
+                         cash, commission)
+
+
+# Simulation of many pairs of TP & SL on the same signal which can be run in steps: the particles can be dropped
+# between the steps (e.g. the hopeless ones), the rest of them continue from the same state.
+# Without numba the steps run as plain Python on the lists of the bars (see simulate_batch_lists).
+class BatchSimulation:
+    def __init__(self, open, high, low, close, direction, fixed_tp, fixed_sl_as_multiple_tp, cash=1000,
+                 commission=0.0004, jit=True):
+        self.arrays = [np.ascontiguousarray(values, dtype=float) for values in (open, high, low, close, direction)]
+        self.fixed_tp = np.array(fixed_tp, dtype=float)
+        self.fixed_sl_as_multiple_tp = np.array(fixed_sl_as_multiple_tp, dtype=float)
+        self.commission = float(commission)
+        self.core = simulate_batch_core_jit if jit and simulate_batch_core_jit is not None else simulate_batch_lists
+
+        m = len(self.fixed_tp)
+        # Indices of the simulated particles in the initial arrays of TP & SL
+        self.rows = np.arange(m)
+        self.bar = 0
+        self.cash = np.full(m, float(cash))
+        self.pos_size = np.zeros(m)
+        self.pos_price = np.zeros(m)
+        self.num_orders = np.zeros(m, dtype=np.int64)
+        self.order_sizes = np.zeros((m, 3))
+        self.order_prices = np.zeros((m, 3))
+        self.values = np.empty((m, len(self.arrays[0])))
+
+    # Simulate the bars up to stop
+    def run(self, stop):
+        if stop > self.bar and len(self.rows) > 0:
+            self.core(*self.arrays, self.fixed_tp, self.fixed_sl_as_multiple_tp, self.commission, self.bar, stop,
+                      self.cash, self.pos_size, self.pos_price, self.num_orders, self.order_sizes,
+                      self.order_prices, self.values)
+        self.bar = max(self.bar, stop)
+        return self.values
+
+    # Simulate the next block of the bars which aren't in the arrays (the out-of-core run, the arrays are empty),
+    # the state of the particles is carried over from the previous block. Returns the values of the block.
+    def run_block(self, open, high, low, close, direction):
+        arrays = [np.ascontiguousarray(values, dtype=float) for values in (open, high, low, close, direction)]
+        values = np.empty((len(self.rows), len(arrays[0])))
+        if len(arrays[0]) > 0 and len(self.rows) > 0:
+            self.core(*arrays, self.fixed_tp, self.fixed_sl_as_multiple_tp, self.commission, 0, len(arrays[0]),
+                      self.cash, self.pos_size, self.pos_price, self.num_orders, self.order_sizes,
+                      self.order_prices, values)
+        self.bar += len(arrays[0])
+        return values
+
+    # Keep simulating only the particles of the mask (of the current particles)
+    def keep(self, mask):
+        for name in ('rows', 'fixed_tp', 'fixed_sl_as_multiple_tp', 'cash', 'pos_size', 'pos_price', 'num_orders',
+                     'order_sizes', 'order_prices', 'values'):
+            setattr(self, name, np.ascontiguousarray(getattr(self, name)[mask]))
+
+
+# Run the simulation for the arrays of TP & SL on the same signal, returns the values of shape (particles, bars)
+def simulate_batch(open, high, low, close, direction, fixed_tp, fixed_sl_as_multiple_tp, cash=1000,
+                   commission=0.0004, jit=True):
+    simulation = BatchSimulation(open, high, low, close, direction, fixed_tp, fixed_sl_as_multiple_tp, cash,
+                                 commission, jit)
+    return simulation.run(len(simulation.arrays[0]))
+
+
+# Compile (or load from the numba cache) the simulation before the timed runs, e.g. in the worker initializer
+def warm_up():
+    prices = np.full(3, 100.0)
+    simulate(prices, prices, prices, prices, np.zeros(3), 0.1, 1.0)
+    BatchSimulation(prices, prices, prices, prices, np.zeros(3), [0.1], [1.0]).run(3)
+
+
+# Periods of the TimeReturn analyzer for the candle timestamps (nanoseconds), the same id for the bars of one period
+def period_ids(timestamps, tf=bt.TimeFrame.Minutes, compression=1):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    days = timestamps // DAY_NS
+    if tf in (bt.TimeFrame.Minutes, bt.TimeFrame.Seconds, bt.TimeFrame.MicroSeconds, bt.TimeFrame.Ticks):
+        unit = {bt.TimeFrame.Minutes: 60 * 10 ** 9, bt.TimeFrame.Seconds: 10 ** 9}.get(tf, 1000)
+        point = (timestamps - days * DAY_NS) // unit
+        return days * (DAY_NS // 1000) + point // compression
+    elif tf == bt.TimeFrame.Days:
+        return days
+    elif tf == bt.TimeFrame.Weeks:
+        # 1970-01-01 is Thursday, ISO weeks start on Monday
+        return (days + 3) // 7
+    elif tf == bt.TimeFrame.Months:
+        return timestamps.astype('datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+    elif tf == bt.TimeFrame.Years:
+        return timestamps.astype('datetime64[ns]').astype('datetime64[Y]').astype(np.int64)
+
+    return np.zeros(len(timestamps), dtype=np.int64)
+
+
+# Returns of the TimeReturn analyzer: the value at the end of every period over the value at the end of the previous
+# one (the starting cash for the first period). Returns the index of the last bar of every period and the returns.
+def period_returns(values, ids, cash):
+    values = np.asarray(values, dtype=float)
+    ends = np.flatnonzero(np.diff(ids) != 0)
+    ends = np.append(ends, len(values) - 1) if len(values) > 0 else ends
+    starts = np.concatenate(([cash], values[ends[:-1]]))
+    return ends, values[ends] / starts - 1.0
+
+
+# Pearson correlation coefficient of the biased covariance matrix of x and y, as the r-value of scipy.stats.linregress
+def correlation_of_covariance(ssxm, ssxym, ssym):
+    if ssxm == 0.0 or ssym == 0.0:
+        return np.nan if ssxym == 0 else 0.0
+
+    return min(max(ssxym / np.sqrt(ssxm * ssym), -1.0), 1.0)
+
+
+# Running moments of the points (x, y) with x = 0, 1, 2, ... coming in blocks: the count, the means and the sums of
+# the squared and the cross deviations. The blocks are merged by the pairwise update of Chan et al. instead of the
+# plain sums of x, y, xy, x^2 and y^2, so the long series loses no precision.
+class RegressionMoments:
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.sxx = 0.0
+        self.syy = 0.0
+        self.sxy = 0.0
+
+    def add(self, y):
+        m = len(y)
+        if m == 0:
+            return
+        x = np.arange(self.n, self.n + m, dtype=float)
+        mean_x, mean_y = x.mean(), y.mean()
+        dx, dy = x - mean_x, y - mean_y
+        delta_x, delta_y = mean_x - self.mean_x, mean_y - self.mean_y
+        n = self.n + m
+        weight = self.n * m / n
+        self.sxx += dx @ dx + delta_x * delta_x * weight
+        self.syy += dy @ dy + delta_y * delta_y * weight
+        self.sxy += dx @ dy + delta_x * delta_y * weight
+        self.mean_x += delta_x * m / n
+        self.mean_y += delta_y * m / n
+        self.n = n
+
+    # ssxm, ssxym, ssym of np.cov(x, y, bias=1)
+    def covariance(self):
+        return self.sxx / self.n, self.sxy / self.n, self.syy / self.n
+
+
+# period_returns and the max drawdown (see Pruner) of the values coming in blocks, only the last bar is carried over:
+# the period of it ends or not depending on the next bar. The stability of the returns (see
+# BacktestTrendBreakerPL.stability_of_timeseries) is kept by the running moments of the cumulative log returns,
+# so with keep_returns=False the memory doesn't grow with the number of the bars and the returns aren't kept.
+class EquityStream:
+    def __init__(self, cash, tf=bt.TimeFrame.Minutes, compression=1, keep_returns=True):
+        self.cash = cash
+        self.tf = tf
+        self.compression = compression
+        self.keep_returns = keep_returns
+        # Value of the previous period end, the last bar and the peak of the values
+        self.start_value = float(cash)
+        self.last = None
+        self.peak = float(cash)
+        self.max_drawdown = 0.0
+        self.end_timestamps = []
+        self.returns = []
+        # Number of the returns, the first and the last cumulative log returns and their moments
+        self.num_returns = 0
+        self.first_log_return = None
+        self.cum_log_return = 0.0
+        self.moments = RegressionMoments()
+
+    def add(self, timestamps, values):
+        if len(values) == 0:
+            return
+        values = np.asarray(values, dtype=float)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        ids = period_ids(timestamps, self.tf, self.compression)
+        peaks = np.maximum.accumulate(np.maximum(values, self.peak))
+        self.max_drawdown = max(self.max_drawdown, np.max(1.0 - values / peaks))
+        self.peak = peaks[-1]
+
+        if self.last is not None:
+            ids = np.concatenate(([self.last[0]], ids))
+            timestamps = np.concatenate(([self.last[1]], timestamps))
+            values = np.concatenate(([self.last[2]], values))
+        ends = np.flatnonzero(np.diff(ids) != 0)
+        if len(ends) > 0:
+            starts = np.concatenate(([self.start_value], values[ends[:-1]]))
+            returns = values[ends] / starts - 1.0
+            if self.keep_returns:
+                self.end_timestamps.append(timestamps[ends])
+                self.returns.append(returns)
+            self.add_moments(returns)
+            self.start_value = values[ends[-1]]
+        self.last = (ids[-1], timestamps[-1], values[-1])
+
+    def add_moments(self, returns):
+        self.num_returns += len(returns)
+        returns = returns[~np.isnan(returns)]
+        if len(returns) > 0:
+            cum_log_returns = self.cum_log_return + np.log1p(returns).cumsum()
+            if self.first_log_return is None:
+                self.first_log_return = cum_log_returns[0]
+            self.cum_log_return = cum_log_returns[-1]
+            self.moments.add(cum_log_returns)
+
+    @property
+    def final_value(self):
+        return self.last[2] if self.last is not None else self.cash
+
+    # Stability of all the returns, the period of the last bar is closed by it. The same as stability_of_timeseries
+    # of the returns of finish up to the rounding.
+    def stability(self):
+        if self.last is None:
+            return np.nan
+        closed = copy.copy(self)
+        closed.moments = copy.copy(self.moments)
+        closed.add_moments(np.array([self.last[2] / self.start_value - 1.0]))
+        if closed.num_returns < 2 or closed.moments.n == 0:
+            return np.nan
+
+        rhat = correlation_of_covariance(*closed.moments.covariance())
+        return rhat ** 2 if closed.first_log_return < closed.cum_log_return else -(rhat ** 2)
+
+    # Timestamps of the last bars of the periods and the returns, the period of the last bar is closed by it
+    def finish(self):
+        end_timestamps = list(self.end_timestamps)
+        returns = list(self.returns)
+        if self.last is not None:
+            end_timestamps.append(np.array([self.last[1]], dtype=np.int64))
+            returns.append(np.array([self.last[2] / self.start_value - 1.0]))
+        if not returns:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(end_timestamps), np.concatenate(returns)
+
+
+# Datetimes of TimeReturn analyzer for the periods: the end of the intraday and daily periods, the last bar otherwise
+def period_keys(timestamps, tf=bt.TimeFrame.Minutes, compression=1):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    days = timestamps // DAY_NS * DAY_NS
+    if tf in (bt.TimeFrame.Minutes, bt.TimeFrame.Seconds):
+        unit = 60 * 10 ** 9 if tf == bt.TimeFrame.Minutes else 10 ** 9
+        point = (timestamps - days) // unit
+        timestamps = days + ((point // compression + 1) * compression - 1) * unit
+    elif tf == bt.TimeFrame.Days:
+        timestamps = days
+
+    return timestamps.astype('datetime64[ns]')
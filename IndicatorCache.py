@@ -0,0 +1,73 @@
+import hashlib
+import multiprocessing
+import os
+from collections import OrderedDict
+import numpy as np
+
+
+# Bounded LRU cache of the indicator output arrays with the optional on-disk tier.
+# Counters of hits and misses can be shared by the worker processes: the cache is created with shared=True
+# in the main process and passed to the workers by the pool initializer.
+class IndicatorCache:
+    def __init__(self, maxsize=64, cache_dir=None, shared=False):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        # Hits in memory, hits on disk and misses
+        self.counters = multiprocessing.Array('q', 3) if shared else [0, 0, 0]
+
+    # Key of the indicator results: fingerprint of the candles and the integer params of the indicator.
+    # The fingerprint of FinamCandles (see DataCache) is taken instead of hashing the candles (O(bars)), it's hashed
+    # itself to make the file name of the disk tier (the fingerprints of the resampled candles have '/' in them).
+    @staticmethod
+    def make_key(candles, *params, fingerprint=None):
+        if fingerprint is None:
+            sha1 = hashlib.sha1()
+            for values in candles:
+                sha1.update(np.ascontiguousarray(values, dtype=float).tobytes())
+            fingerprint = sha1.hexdigest()
+        return '_'.join([hashlib.sha1(fingerprint.encode()).hexdigest()] + [str(int(p)) for p in params])
+
+    def count(self, ind):
+        if isinstance(self.counters, list):
+            self.counters[ind] += 1
+        else:
+            with self.counters.get_lock():
+                self.counters[ind] += 1
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.count(0)
+            return self.entries[key]
+
+        if self.cache_dir is not None:
+            file_name = os.path.join(self.cache_dir, key + '.npz')
+            if os.path.exists(file_name):
+                with np.load(file_name) as f:
+                    outputs = tuple(f['arr_{0}'.format(i)] for i in range(len(f.files)))
+                self.store(key, outputs)
+                self.count(1)
+                return outputs
+
+        self.count(2)
+        return None
+
+    def put(self, key, outputs):
+        self.store(key, outputs)
+        if self.cache_dir is not None:
+            # Write and rename, so the concurrent readers never see the partial file
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_file = os.path.join(self.cache_dir, '{0}.{1}.tmp.npz'.format(key, os.getpid()))
+            np.savez(tmp_file, *outputs)
+            os.replace(tmp_file, os.path.join(self.cache_dir, key + '.npz'))
+
+    def store(self, key, outputs):
+        self.entries[key] = outputs
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        hits, disk_hits, misses = self.counters[:]
+        return {'hits': hits, 'disk_hits': disk_hits, 'misses': misses}
@@ -0,0 +1,198 @@
+import contextlib
+import cProfile
+import functools
+import glob
+import heapq
+import json
+import os
+import time
+import tracemalloc
+
+# pyinstrument is optional: the slowest evaluations are captured with cProfile if it isn't installed
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+# Instrumentation recording the stages of this process, nothing is recorded while it's None
+active = None
+
+
+# Wall time, number of calls and allocated memory of the stages of the backtests. The stages are nested, the path
+# of the stage is the names of the outer stages and its own one joined by ';' (the stacks of the flamegraph).
+class Instrumentation:
+    def __init__(self, track_allocations=False):
+        # Path -> [calls, seconds, seconds of the nested stages, allocated bytes]
+        self.stages = {}
+        self.stack = []
+        # Allocations are traced by tracemalloc, which slows down the backtest several times
+        self.track_allocations = track_allocations
+
+    # Record the stages in the block
+    @contextlib.contextmanager
+    def activate(self):
+        global active
+        previous = active
+        active = self
+        start_tracing = self.track_allocations and not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+        try:
+            yield self
+        finally:
+            active = previous
+            if start_tracing:
+                tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.stack.append(name)
+        path = ';'.join(self.stack)
+        tracing = self.track_allocations and tracemalloc.is_tracing()
+        memory = tracemalloc.get_traced_memory()[0] if tracing else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            record = self.stages.setdefault(path, [0, 0.0, 0.0, 0])
+            record[0] += 1
+            record[1] += elapsed
+            if tracing:
+                record[3] += tracemalloc.get_traced_memory()[0] - memory
+            if self.stack:
+                self.stages.setdefault(';'.join(self.stack), [0, 0.0, 0.0, 0])[2] += elapsed
+
+    # Add the stages of the other instrumentation (or of its dict), e.g. of the other evaluation or process
+    def merge(self, other):
+        stages = other.stages if isinstance(other, Instrumentation) else \
+            {path: [s['calls'], s['seconds'], s['seconds'] - s['self_seconds'], s['alloc_bytes']]
+             for path, s in other['stages'].items()}
+        for path, values in stages.items():
+            record = self.stages.setdefault(path, [0, 0.0, 0.0, 0])
+            for i, value in enumerate(values):
+                record[i] += value
+
+    def to_dict(self):
+        return {'stages': {path: {'calls': calls,
+                                  'seconds': seconds,
+                                  'self_seconds': seconds - nested,
+                                  'alloc_bytes': alloc_bytes}
+                           for path, (calls, seconds, nested, alloc_bytes) in self.stages.items()}}
+
+    # Totals of the stages by their names, the nested calls of the same stage are counted once
+    def by_name(self):
+        totals = {}
+        for path, (calls, seconds, _, alloc_bytes) in self.stages.items():
+            names = path.split(';')
+            if names[-1] in names[:-1]:
+                continue
+            total = totals.setdefault(names[-1], [0, 0.0, 0])
+            total[0] += calls
+            total[1] += seconds
+            total[2] += alloc_bytes
+        return totals
+
+    def save_json(self, file_name):
+        write_file(file_name, json.dumps(self.to_dict(), indent=2))
+
+    # Collapsed stacks with the self time in microseconds (flamegraph.pl, speedscope, inferno)
+    def save_collapsed(self, file_name):
+        lines = ['{0} {1}'.format(path, int(round((seconds - nested) * 1e6)))
+                 for path, (_, seconds, nested, _) in sorted(self.stages.items())]
+        write_file(file_name, '\n'.join(lines) + '\n')
+
+
+def write_file(file_name, text):
+    tmp_file = '{0}.{1}.tmp'.format(file_name, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+    os.replace(tmp_file, file_name)
+
+
+# The stage of the active instrumentation
+def stage(name):
+    return active.stage(name) if active is not None else contextlib.nullcontext()
+
+
+# Decorator recording the function as the stage
+def staged(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if active is None:
+                return func(*args, **kwargs)
+            with active.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Instrumentation of the evaluations of the optimization in the worker process: the stages of all the evaluations
+# are summed and written to profile_dir after every evaluation, the profiles of the slowest ones are kept there.
+# The main process joins the files of the workers with collect.
+class EvaluationProfiler:
+    def __init__(self, profile_dir, slowest=0, profiler='cprofile', track_allocations=False):
+        self.profile_dir = profile_dir
+        self.slowest = slowest
+        self.profiler = profiler if profiler != 'pyinstrument' or pyinstrument is not None else 'cprofile'
+        self.instrumentation = Instrumentation(track_allocations=track_allocations)
+        # Heap of (seconds, file name) of the kept profiles
+        self.profiles = []
+        os.makedirs(profile_dir, exist_ok=True)
+
+    # Evaluate func(*args) with the stages recorded and the profile captured
+    def run(self, func, *args):
+        profile = None
+        if self.slowest > 0:
+            profile = pyinstrument.Profiler() if self.profiler == 'pyinstrument' else cProfile.Profile()
+            profile.start() if self.profiler == 'pyinstrument' else profile.enable()
+
+        start = time.perf_counter()
+        with self.instrumentation.activate():
+            result = func(*args)
+        elapsed = time.perf_counter() - start
+
+        if profile is not None:
+            profile.stop() if self.profiler == 'pyinstrument' else profile.disable()
+            if len(self.profiles) < self.slowest or elapsed > self.profiles[0][0]:
+                self.keep_profile(profile, elapsed)
+
+        self.instrumentation.save_json(os.path.join(self.profile_dir, 'stages-{0}.json'.format(os.getpid())))
+        return result
+
+    def keep_profile(self, profile, elapsed):
+        file_name = os.path.join(self.profile_dir, 'slow-{0:.6f}-{1}-{2}.{3}'.format(
+            elapsed, os.getpid(), time.perf_counter_ns(), 'html' if self.profiler == 'pyinstrument' else 'prof'))
+        if self.profiler == 'pyinstrument':
+            write_file(file_name, profile.output_html())
+        else:
+            profile.dump_stats(file_name)
+
+        heapq.heappush(self.profiles, (elapsed, file_name))
+        if len(self.profiles) > self.slowest:
+            os.remove(heapq.heappop(self.profiles)[1])
+
+    # Remove the files of the previous run
+    @staticmethod
+    def reset(profile_dir):
+        for file_name in glob.glob(os.path.join(profile_dir, 'stages-*.json')) + \
+                glob.glob(os.path.join(profile_dir, 'slow-*')):
+            os.remove(file_name)
+
+    # Join the stages of the workers, keep the slowest profiles of all the workers.
+    # Returns the instrumentation and the list of the kept profiles, the slowest first
+    @staticmethod
+    def collect(profile_dir, slowest=0):
+        instrumentation = Instrumentation()
+        for file_name in glob.glob(os.path.join(profile_dir, 'stages-*.json')):
+            with open(file_name) as f:
+                instrumentation.merge(json.load(f))
+
+        profiles = sorted(glob.glob(os.path.join(profile_dir, 'slow-*')),
+                          key=lambda name: float(os.path.basename(name).split('-')[1]), reverse=True)
+        for file_name in profiles[slowest:]:
+            os.remove(file_name)
+
+        return instrumentation, profiles[:slowest]
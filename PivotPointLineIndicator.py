@@ -1,133 +1,345 @@
 import backtrader as bt
-import pandas as pd
 import numpy as np
+import operator
+from array import array
+from collections import deque
+from Instrumentation import staged
+
+
+# Sliding window extreme (max or min) over every full window of the values, O(n) by van Herk / Gil-Werman:
+# the values are split into blocks of window length, so each window is the suffix of one block and the prefix of the next
+def sliding_extreme(values, window, ufunc=np.maximum):
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if window < 1 or n < window:
+        return np.empty(0)
+
+    # Pad with the neutral element, so the last block is complete
+    neutral = -np.inf if ufunc is np.maximum else np.inf
+    num_blocks = -(-n // window)
+    blocks = np.full(num_blocks * window, neutral)
+    blocks[:n] = values
+    blocks = blocks.reshape(num_blocks, window)
+
+    prefix = ufunc.accumulate(blocks, axis=1).ravel()
+    suffix = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+
+    return ufunc(suffix[:n - window + 1], prefix[window - 1:n])
+
+
+# Determine the pivot points: the bar is the extreme of pivot_window_len bars at the left and at the right side
+def find_pivot_points(high, low, pivot_window_len):
+    high = np.asarray(high, dtype=float)
+    low = np.asarray(low, dtype=float)
+    n = len(high)
+    pivot_up = np.zeros(n, dtype=bool)
+    pivot_down = np.zeros(n, dtype=bool)
+    if n < 2 * pivot_window_len + 1:
+        return pivot_up, pivot_down
+
+    window = pivot_window_len + 1
+    inner = slice(pivot_window_len, n - pivot_window_len)
+    high_rolling = sliding_extreme(high, window, np.maximum)
+    low_rolling = sliding_extreme(low, window, np.minimum)
+
+    pivot_up[inner] = (low[inner] == low_rolling[:n - 2 * pivot_window_len]) & \
+                      (low[inner] == low_rolling[pivot_window_len:])
+    pivot_down[inner] = (high[inner] == high_rolling[:n - 2 * pivot_window_len]) & \
+                        (high[inner] == high_rolling[pivot_window_len:])
+
+    return pivot_up, pivot_down
+
+
+# For every pivot point find the nearest previous pivot point with the price beyond it (higher for the pivot down
+# points, lower for the pivot up points), -1 if there is no such point
+def previous_beyond_pivots(pivots, prices, beyond):
+    prev_pivots = np.full(len(pivots), -1, dtype=np.int64)
+    stack = []
+    for ind in np.flatnonzero(pivots):
+        while stack and not beyond(prices[stack[-1]], prices[ind]):
+            stack.pop()
+        if stack:
+            prev_pivots[ind] = stack[-1]
+        stack.append(ind)
+
+    return prev_pivots
+
+
+# Trend lines through the last pivot point and the previous one beyond it within the history for every bar from
+# history_bars_length: the bar sees the history of the previous bars only, the last pivot_window_len bars of it
+# can't have the confirmed pivot point yet
+def trend_lines(pivots, prices, pivot_window_len, history_bars_length, beyond):
+    n = len(prices)
+    now = np.arange(history_bars_length, n)
+    history_start = now - history_bars_length
+
+    # The last pivot point found incrementally, it's the same for all bars until the next one is confirmed
+    last_pivots = np.maximum.accumulate(np.where(pivots, np.arange(n), -1))
+    ind_last = now - pivot_window_len - 1
+    ind_current = np.full(len(now), -1, dtype=np.int64)
+    if pivot_window_len > 0:
+        ind_current[ind_last >= 0] = last_pivots[ind_last[ind_last >= 0]]
+    has_current = ind_current >= history_start
+
+    prev_pivots = previous_beyond_pivots(pivots, prices, beyond)
+    ind_prev = np.full(len(now), -1, dtype=np.int64)
+    ind_prev[has_current] = prev_pivots[ind_current[has_current]]
+    has_line = has_current & (ind_prev >= history_start)
+
+    # Calculate the trend lines at the last bar of the history
+    ind_now = now[has_line] - 1
+    ind_current = ind_current[has_line]
+    ind_prev = ind_prev[has_line]
+    price_current = prices[ind_current]
+    dydx_ratio = (price_current - prices[ind_prev]) / (ind_current - ind_prev)
+    pivot_line = price_current + dydx_ratio * (ind_now - ind_current)
+
+    return now[has_line], dydx_ratio, pivot_line
+
+
+# Calculate the indicator for the candles: status of pivot points, the value of pivot line and trade direction
+def pivot_point_line(open, high, low, close, pivot_window_len, history_bars_as_multiple_pwl):
+    open = np.asarray(open, dtype=float)
+    close = np.asarray(close, dtype=float)
+    high = np.asarray(high, dtype=float)
+    low = np.asarray(low, dtype=float)
+    history_bars_length = pivot_window_len * history_bars_as_multiple_pwl
+
+    n = len(close)
+    pl_value = np.full(n, -1.0)
+    direction = np.zeros(n)
+    pivot_up, pivot_down = find_pivot_points(high, low, pivot_window_len)
+
+    # Check LONG direction based on Pivot Down points
+    pivot_line = np.full(n, -1.0)
+    direction_long = np.zeros(n, dtype=bool)
+    ind, dydx_ratio, line = trend_lines(pivot_down, high, pivot_window_len, history_bars_length, operator.gt)
+    pivot_line[ind] = line
+    direction_long[ind] = (dydx_ratio < 0) & (close[ind - 1] > line) & (line > open[ind - 1])
+
+    # Check SHORT direction based on Pivot Up points
+    direction_short = np.zeros(n, dtype=bool)
+    ind, dydx_ratio, line = trend_lines(pivot_up, low, pivot_window_len, history_bars_length, operator.lt)
+    pivot_line[ind] = line
+    direction_short[ind] = (dydx_ratio > 0) & (close[ind - 1] < line) & (line < open[ind - 1])
+
+    # Set values only if we don't get 2 directions at the same time
+    single = ~(direction_long & direction_short)
+    pl_value[single] = pivot_line[single]
+    direction[direction_long & single] = 1.0
+    direction[direction_short & single] = -1.0
+
+    return pivot_up, pivot_down, pl_value, direction
+
+
+# pivot_point_line for the candles, reusing the results of IndicatorCache. The fingerprint of the candles (see
+# FinamCandles) keys the results without hashing the arrays.
+def cached_pivot_point_line(candles, pivot_window_len, history_bars_as_multiple_pwl, cache=None, fingerprint=None):
+    if cache is None:
+        return pivot_point_line(*candles,
+                                pivot_window_len=pivot_window_len,
+                                history_bars_as_multiple_pwl=history_bars_as_multiple_pwl)
+
+    key = cache.make_key(candles, pivot_window_len, history_bars_as_multiple_pwl, fingerprint=fingerprint)
+    outputs = cache.get(key)
+    if outputs is None:
+        outputs = pivot_point_line(*candles,
+                                   pivot_window_len=pivot_window_len,
+                                   history_bars_as_multiple_pwl=history_bars_as_multiple_pwl)
+        cache.put(key, outputs)
+
+    return outputs
+
+
+# Output lines of PivotPointLine for all the candles, exactly as the indicator fills them in backtrader
+@staged('indicator')
+def pivot_point_line_lines(open, high, low, close, pivot_window_len, history_bars_as_multiple_pwl, cache=None,
+                           fingerprint=None):
+    candles = [np.asarray(values, dtype=float) for values in (open, high, low, close)]
+    outputs = cached_pivot_point_line(candles, pivot_window_len, history_bars_as_multiple_pwl, cache, fingerprint)
+    return [values.astype(float) for values in outputs]
+
+
+# pivot_point_line for the candles coming in blocks of (open, high, low, close), e.g. read from the disk: the memory
+# is bounded by the block and the tail of history_bars_length + pivot_window_len bars carried over to the next block.
+# The direction of the bar depends on the pivot points within its history only, and the pivot point needs
+# pivot_window_len bars at the both sides, so the tail gives the same results as the calculation on all the candles.
+# Yields (index of the first bar, output lines) for the consecutive ranges of the bars. The pivot statuses of the last
+# pivot_window_len bars aren't known until the next block, so these bars are yielded with it.
+def pivot_point_line_blocks(blocks, pivot_window_len, history_bars_as_multiple_pwl):
+    tail = pivot_window_len * history_bars_as_multiple_pwl + pivot_window_len
+    candles = [np.empty(0)] * 4
+    outputs = None
+    # Index of the first bar of candles and the number of the yielded bars
+    first = 0
+    done = 0
+    for block in blocks:
+        candles = [np.concatenate((values, np.asarray(block_values, dtype=float)))
+                   for values, block_values in zip(candles, block)]
+        outputs = pivot_point_line(*candles, pivot_window_len=pivot_window_len,
+                                   history_bars_as_multiple_pwl=history_bars_as_multiple_pwl)
+        ready = first + len(candles[0]) - pivot_window_len
+        if ready > done:
+            yield done, [values[done - first:ready - first].astype(float) for values in outputs]
+            done = ready
+
+        # Keep the history of the bars which aren't yielded yet
+        keep = max(done - tail, first)
+        candles = [values[keep - first:] for values in candles]
+        first = keep
+
+    end = first + len(candles[0])
+    if outputs is not None and end > done:
+        yield done, [values[len(values) - (end - done):].astype(float) for values in outputs]
+
+
+# Incremental pivot_point_line for the live bar by bar operation, gives the same results as the batch calculation.
+# The state is O(history_bars_length): the sliding extremes of the last 2 * pivot_window_len + 1 bars waiting for the
+# confirmation of the pivot point in the middle of them, the stacks of the pivot points within the history
+# (up to history_bars_length = pivot_window_len * history_bars_as_multiple_pwl bars) and the last pivot points.
+class PivotPointLineStream:
+    def __init__(self, pivot_window_len=12, history_bars_as_multiple_pwl=30):
+        self.pivot_window_len = pivot_window_len
+        self.history_bars_length = pivot_window_len * history_bars_as_multiple_pwl
+        self.ind = -1
+        self.prev_open = np.nan
+        self.prev_close = np.nan
+        # Monotonic deques of (index, price) of the sliding max of highs and min of lows
+        self.recent = deque(maxlen=pivot_window_len + 1)
+        self.highs = deque()
+        self.lows = deque()
+        # For the pivot down (high) and pivot up (low) points: the stack of the pivot points for finding
+        # the previous one beyond the price, the last pivot point and the previous one beyond it
+        self.pivots = {'down': deque(), 'up': deque()}
+        self.current = {'down': None, 'up': None}
+
+    # Process the next candle: returns the pivot up and down statuses of the bar pivot_window_len bars ago
+    # (None while there are not enough bars), the pivot line value and the direction of the candle
+    def update(self, open, high, low, close):
+        self.ind += 1
+        pl_value, direction = self.direction()
+        pivot_up, pivot_down = self.confirm_pivots(high, low)
+        self.prev_open, self.prev_close = open, close
+
+        return pivot_up, pivot_down, pl_value, direction
+
+    # Direction of the current bar by the history of the previous bars (the same as in pivot_point_line)
+    def direction(self):
+        history_start = self.ind - self.history_bars_length
+        if history_start < 0:
+            return -1.0, 0.0
+
+        pivot_line = -1.0
+        direction_long = direction_short = False
+        line = self.trend_line('down', history_start)
+        if line is not None:
+            dydx_ratio, pivot_line = line
+            direction_long = dydx_ratio < 0 and self.prev_close > pivot_line > self.prev_open
+
+        line = self.trend_line('up', history_start)
+        if line is not None:
+            dydx_ratio, pivot_line = line
+            direction_short = dydx_ratio > 0 and self.prev_close < pivot_line < self.prev_open
+
+        # Set values only if we don't get 2 directions at the same time
+        if direction_long and direction_short:
+            return -1.0, 0.0
+        return pivot_line, 1.0 if direction_long else -1.0 if direction_short else 0.0
+
+    # The slope and the value at the previous bar of the trend line through the last pivot point and the previous
+    # one beyond it, None if any of them is out of the history
+    def trend_line(self, side, history_start):
+        current = self.current[side]
+        if current is None:
+            return None
+        ind_current, price_current, ind_prev, price_prev = current
+        if ind_current < history_start or ind_prev < history_start:
+            return None
+
+        dydx_ratio = (price_current - price_prev) / (ind_current - ind_prev)
+        return dydx_ratio, price_current + dydx_ratio * (self.ind - 1 - ind_current)
+
+    # Add the bar to the sliding extremes and confirm the pivot point in the middle of them
+    def confirm_pivots(self, high, low):
+        pivot_window_len = self.pivot_window_len
+        window = 2 * pivot_window_len + 1
+        self.recent.append((high, low))
+        for values, price, beyond in ((self.highs, high, operator.ge), (self.lows, low, operator.le)):
+            while values and beyond(price, values[-1][1]):
+                values.pop()
+            values.append((self.ind, price))
+            if values[0][0] <= self.ind - window:
+                values.popleft()
+
+        ind = self.ind - pivot_window_len
+        if ind < pivot_window_len:
+            return None, None
+
+        # The bar is the pivot point if it's the extreme of the both sides of it, i.e. of the whole window
+        high, low = self.recent[0]
+        is_pivot_down = high == self.highs[0][1]
+        is_pivot_up = low == self.lows[0][1]
+        if is_pivot_down:
+            self.add_pivot('down', ind, high, operator.gt)
+        if is_pivot_up:
+            self.add_pivot('up', ind, low, operator.lt)
+
+        return float(is_pivot_up), float(is_pivot_down)
+
+    # The new last pivot point and the nearest previous one beyond its price (see previous_beyond_pivots)
+    def add_pivot(self, side, ind, price, beyond):
+        if self.pivot_window_len == 0:
+            return
+
+        stack = self.pivots[side]
+        # The pivot points older than the history of the next bar can't make the trend line anymore
+        while stack and stack[0][0] < self.ind + 1 - self.history_bars_length:
+            stack.popleft()
+        while stack and not beyond(stack[-1][1], price):
+            stack.pop()
+        ind_prev, price_prev = stack[-1] if stack else (-1, np.nan)
+        stack.append((ind, price))
+        self.current[side] = (ind, price, ind_prev, price_prev)
 
 
 class PivotPointLine(bt.Indicator):
     lines = ('pivot_up', 'pivot_down', 'pl_value', 'direction',)
     params = (
         ('pivot_window_len', 12),
-        ('history_bars_as_multiple_pwl', 30)
+        ('history_bars_as_multiple_pwl', 30),
+        ('cache', None)     # IndicatorCache for reusing the results of the same candles and params
     )
 
+    def __init__(self):
+        self.stream = PivotPointLineStream(pivot_window_len=self.params.pivot_window_len,
+                                           history_bars_as_multiple_pwl=self.params.history_bars_as_multiple_pwl)
+
+    # Bar by bar mode (live feeds, runonce=False): the pivot point statuses are known pivot_window_len bars later,
+    # so they are set to False for the current bar and overwritten when the bar is confirmed
+    def next(self):
+        pivot_up, pivot_down, pl_value, direction = self.stream.update(self.data_open[0], self.data_high[0],
+                                                                       self.data_low[0], self.data_close[0])
+        self.lines.pivot_up[0] = 0.0
+        self.lines.pivot_down[0] = 0.0
+        if pivot_up is not None:
+            self.lines.pivot_up[-self.params.pivot_window_len] = pivot_up
+            self.lines.pivot_down[-self.params.pivot_window_len] = pivot_down
+        self.lines.pl_value[0] = pl_value
+        self.lines.direction[0] = direction
+
+    @staged('indicator')
     def once(self, start, end):
-        history_bars_length = self.params.pivot_window_len * self.params.history_bars_as_multiple_pwl
-
-        # Define the references for the output lines
-        pivot_up = self.lines.pivot_up.array
-        pivot_down = self.lines.pivot_down.array
-        pl_value = self.lines.pl_value.array
-        pl_direction = self.lines.direction.array
-
-        # Create the dataframe with candles for storaging price and other information
-        candles = pd.DataFrame()
-        for i in range(start, end):
-            candles = candles.append({'open': self.data_open[i],
-                                      'high': self.data_high[i],
-                                      'low': self.data_low[i],
-                                      'close': self.data_close[i],
-                                      'pivot_up': False,
-                                      'pivot_down': False,
-                                      'pl_value': -1.0,
-                                      'direction': 0.0},
-                                     ignore_index=True)
-
-        # Determine the pivot points
-        candles['high_rolling_left'] = candles['high'].rolling(self.params.pivot_window_len + 1).apply(np.max, raw=True)
-        candles['low_rolling_left'] = candles['low'].rolling(self.params.pivot_window_len + 1).apply(np.min, raw=True)
-        candles['high_rolling_right'] = candles['high'][::-1].rolling(self.params.pivot_window_len + 1).apply(np.max,
-                                                                                                              raw=True)
-        candles['low_rolling_right'] = candles['low'][::-1].rolling(self.params.pivot_window_len + 1).apply(np.min,
-                                                                                                            raw=True)
-        candles['pivot_up'] = [True if x.low == x.low_rolling_left and x.low == x.low_rolling_right else False
-                               for x in candles.itertuples()]
-        candles['pivot_down'] = [True if x.high == x.high_rolling_left and x.high == x.high_rolling_right else False
-                                 for x in candles.itertuples()]
-
-        for i in range(history_bars_length, candles.shape[0]):
-            tmp_df = candles[(i - history_bars_length):i]
-            direction = 0.0
-            direction_long = False
-            direction_short = False
-            pivot_line = -1.0
-
-            # Check LONG direction based on Pivot Down points
-            # Stupidly, but yet another one condition is not hurt
-            if candles.shape[0] > 0:
-                ind_current_pivot_down = -1
-                potential_pivots_down = \
-                    np.where(tmp_df['pivot_down'][:(-self.params.pivot_window_len)] == True)[0]
-                if len(potential_pivots_down) > 0:
-                    ind_current_pivot_down = potential_pivots_down[-1] + 1
-
-                if ind_current_pivot_down > -1:
-                    high_price_current_pivot_down = tmp_df['high'].iat[ind_current_pivot_down - 1]
-                    # Get satisfied bars (price level and pivot point status)
-                    prev_highs = np.where(
-                        (tmp_df['high'][:(ind_current_pivot_down - 1)] > high_price_current_pivot_down) & (
-                                tmp_df['pivot_down'][:(ind_current_pivot_down - 1)] == True))[0]
-
-                    # If we've got these bars
-                    if len(prev_highs) > 0:
-                        # Get additional information
-                        open_price_now = tmp_df['open'].iat[-1]
-                        close_price_now = tmp_df['close'].iat[-1]
-                        high_price_prev_good_pivot_down = tmp_df['high'].iat[prev_highs[-1]]
-                        ind_prev_good_pivot_down = prev_highs[-1] + 1
-                        num_bars_between_pivot_down_points = ind_current_pivot_down - ind_prev_good_pivot_down
-                        num_bars_between_current_pivot_down_now = history_bars_length - ind_current_pivot_down
-
-                        # Calculate trend line and make the decision
-                        dydx_ratio = (
-                                             high_price_current_pivot_down - high_price_prev_good_pivot_down) / num_bars_between_pivot_down_points
-                        pivot_line = high_price_current_pivot_down + dydx_ratio * num_bars_between_current_pivot_down_now
-                        if dydx_ratio < 0 and close_price_now > pivot_line > open_price_now:
-                            direction_long = True
-                            direction = 1.0
-
-            # # Check SHORT direction based on Pivot Up points
-            # Stupidly, but yet another one condition is not hurt
-            if candles.shape[0] > 0:
-                ind_current_pivot_up = -1
-                potential_pivots_up = \
-                    np.where(tmp_df['pivot_up'][:(-self.params.pivot_window_len)] == True)[0]
-                if len(potential_pivots_up) > 0:
-                    ind_current_pivot_up = potential_pivots_up[-1] + 1
-
-                if ind_current_pivot_up > -1:
-                    low_price_current_pivot_up = tmp_df['low'].iat[ind_current_pivot_up - 1]
-                    # Get satisfied bars (price level and pivot point status)
-                    prev_lows = np.where(
-                        (tmp_df['low'][:(ind_current_pivot_up - 1)] < low_price_current_pivot_up) & (
-                                tmp_df['pivot_up'][:(ind_current_pivot_up - 1)] == True))[0]
-
-                    # If we've got these bars
-                    if len(prev_lows) > 0:
-                        # Get additional information
-                        open_price_now = tmp_df['open'].iat[-1]
-                        close_price_now = tmp_df['close'].iat[-1]
-                        low_price_prev_good_pivot_up = tmp_df['low'].iat[prev_lows[-1]]
-                        ind_prev_good_pivot_up = prev_lows[-1] + 1
-                        num_bars_between_pivot_up_points = ind_current_pivot_up - ind_prev_good_pivot_up
-                        num_bars_between_current_pivot_up_now = history_bars_length - ind_current_pivot_up
-
-                        # Calculate trend line and make the decision
-                        dydx_ratio = (
-                                             low_price_current_pivot_up - low_price_prev_good_pivot_up) / num_bars_between_pivot_up_points
-                        pivot_line = low_price_current_pivot_up + dydx_ratio * num_bars_between_current_pivot_up_now
-                        if dydx_ratio > 0 and close_price_now < pivot_line < open_price_now:
-                            direction_short = True
-                            direction = -1.0
-
-            # Set values only if we don't get 2 directions at the same time
-            if not direction_long or not direction_short:
-                candles['pl_value'].iat[i] = pivot_line
-                candles['direction'].iat[i] = direction
+        candles = [np.asarray(line.array[:end]) for line in (self.data_open, self.data_high,
+                                                             self.data_low, self.data_close)]
+        # All the candles of FinamArrays are keyed by their fingerprint
+        dataname = getattr(self.data.params, 'dataname', None)
+        fingerprint = getattr(dataname, 'fingerprint', None) if end == len(getattr(dataname, 'close', ())) else None
+        outputs = cached_pivot_point_line(candles,
+                                          pivot_window_len=self.params.pivot_window_len,
+                                          history_bars_as_multiple_pwl=self.params.history_bars_as_multiple_pwl,
+                                          cache=self.params.cache,
+                                          fingerprint=fingerprint)
 
         # Fill the output indicator lines (status of pivot points)
-        # 'end - 1' - Kostyl for exception fixing
-        for i in range(start, end - 1):
-            pivot_up[i] = candles['pivot_up'][i]
-            pivot_down[i] = candles['pivot_down'][i]
-            pl_value[i] = candles['pl_value'][i]
-            pl_direction[i] = candles['direction'][i]
\ No newline at end of file
+        for line, values in zip(self.lines, outputs):
+            line.array[start:end] = array('d', values[start:end].astype(float).tobytes())
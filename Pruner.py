@@ -0,0 +1,108 @@
+import multiprocessing
+import numpy as np
+
+
+# Early termination of the evaluations: the equity curve of the backtest is checked at the checkpoints
+# (fractions of the bars) and the backtest is stopped if
+# - the drawdown is already deeper than max_drawdown. The rule is exact: the final drawdown can't be less, so the
+#   evaluation breaks the drawdown limit whatever the rest of the bars,
+# - the stability of the returns so far is below min_stability (heuristic),
+# - or it's below the stability of the swarm's best known position by more than best_margin (heuristic).
+# The pruned evaluation gets a value below the whole range of the stability (-1..1): from -1 - 2 * penalty to
+# -1 - penalty, higher for the higher stability at the checkpoint, so it's worse than any completed evaluation.
+# There is no bound on the final stability from the partial equity curve (any curve so far can still end with R^2
+# near 1), so the heuristic rules only extrapolate it: they can stop the evaluations which would have beaten the best
+# one and make the search worse. They are off unless min_stability or best_margin is set.
+# With shared=True the counters and the best stability are shared by the worker processes (see IndicatorCache).
+class Pruner:
+    def __init__(self,
+                 checkpoints=(0.25, 0.5, 0.75),
+                 min_stability=None,
+                 best_margin=None,
+                 max_drawdown=None,
+                 penalty=1.0,
+                 shared=False
+                 ):
+        assert penalty > 0, 'The penalty must be positive to rank the pruned evaluations below the completed ones'
+        self.checkpoints = checkpoints
+        self.min_stability = min_stability
+        self.best_margin = best_margin
+        self.max_drawdown = max_drawdown
+        self.penalty = penalty
+        # Completed and pruned evaluations, simulated and skipped bars, time of the simulation
+        self.counters = multiprocessing.Array('d', 5) if shared else [0.0, 0.0, 0.0, 0.0, 0.0]
+        self.best = multiprocessing.Value('d', np.nan) if shared else None
+        self.best_stability = np.nan
+
+    # Bar indices of the checkpoints for the candles of num_bars
+    def checkpoint_bars(self, num_bars):
+        return sorted(set(int(num_bars * fraction) for fraction in self.checkpoints
+                          if 0 < int(num_bars * fraction) < num_bars))
+
+    # True if the heuristic rules are enabled, they can prune the evaluations which would have been the best
+    @property
+    def heuristic(self):
+        return self.min_stability is not None or self.best_margin is not None
+
+    # Settings of the pruning, the objective values depend on them
+    def config(self):
+        return {'checkpoints': [float(fraction) for fraction in self.checkpoints],
+                'min_stability': self.min_stability,
+                'best_margin': self.best_margin,
+                'max_drawdown': self.max_drawdown,
+                'penalty': self.penalty}
+
+    def set_best(self, stability):
+        if self.best is not None:
+            self.best.value = stability
+        self.best_stability = stability
+
+    def get_best(self):
+        return self.best.value if self.best is not None else self.best_stability
+
+    # Check the evaluation at the checkpoint: True if it should be pruned
+    def check(self, stability, drawdown):
+        if self.max_drawdown is not None and drawdown > self.max_drawdown:
+            return True
+        if np.isnan(stability):
+            return False
+        if self.min_stability is not None and stability < self.min_stability:
+            return True
+        best = self.get_best()
+        return self.best_margin is not None and not np.isnan(best) and stability < best - self.best_margin
+
+    # Value of the evaluation pruned with the stability at the checkpoint, the unknown stability counts as -1
+    def penalized(self, stability):
+        stability = stability if not np.isnan(stability) else -1.0
+        return -1.0 - self.penalty * (1.0 + (1.0 - stability) / 2.0)
+
+    def count(self, pruned, bars_simulated, bars_skipped):
+        self.add([0.0 if pruned else 1.0, 1.0 if pruned else 0.0, bars_simulated, bars_skipped, 0.0])
+
+    def count_time(self, seconds):
+        self.add([0.0, 0.0, 0.0, 0.0, seconds])
+
+    def add(self, values):
+        if isinstance(self.counters, list):
+            self.counters[:] = [a + b for a, b in zip(self.counters, values)]
+        else:
+            with self.counters.get_lock():
+                for i, value in enumerate(values):
+                    self.counters[i] += value
+
+    def stats(self):
+        completed, pruned, bars_simulated, bars_skipped, simulation_time = self.counters[:]
+        total = bars_simulated + bars_skipped
+        return {'completed': int(completed),
+                'pruned': int(pruned),
+                'bars_simulated': int(bars_simulated),
+                'bars_skipped': int(bars_skipped),
+                'skipped_fraction': bars_skipped / total if total > 0 else 0.0,
+                # Simulation time of the skipped bars at the average time per simulated bar
+                'time_saved': simulation_time * bars_skipped / bars_simulated if bars_simulated > 0 else 0.0}
+
+
+# Maximal drawdown of the values from the starting cash, as a fraction of the peak
+def max_drawdown(values, cash):
+    peaks = np.maximum.accumulate(np.maximum(values, cash), axis=-1)
+    return np.max(1.0 - values / peaks, axis=-1, initial=0.0)
@@ -0,0 +1,161 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+
+# Source files of the backtest, the results of the other versions of them aren't reused. DataCache.py parses and
+# resamples the candles (and has CACHE_VERSION of their cache), so it's a part of the version too.
+CODE_FILES = ('BacktestTrendBreakerPL.py', 'TrendBreakerPLStrategy.py', 'PivotPointLineIndicator.py',
+              'FastSimulator.py', 'EquityRecorderAnalyzer.py', 'DataFeedFormat.py', 'DataCache.py')
+# Columns of the runs table which can be queried: name -> SQLite type
+RUN_COLUMNS = {'key': 'TEXT PRIMARY KEY',
+               'dataset': 'TEXT',
+               'file': 'TEXT',
+               'instrument': 'TEXT',
+               'engine': 'TEXT',
+               'code_version': 'TEXT',
+               'pivot_window_len': 'INTEGER',
+               'history_bars_as_multiple_pwl': 'INTEGER',
+               'fixed_tp': 'REAL',
+               'fixed_sl_as_multiple_tp': 'REAL',
+               'cash': 'REAL',
+               'commission': 'REAL',
+               'timeframe': 'INTEGER',
+               'compression': 'INTEGER',
+               'window_start': 'INTEGER',
+               'window_stop': 'INTEGER',
+               'final_value': 'REAL',
+               'total_return': 'REAL',
+               'stability': 'REAL',
+               'max_drawdown': 'REAL',
+               'trades': 'INTEGER',
+               'runtime': 'REAL',
+               'created': 'REAL'}
+
+code_version_sha1 = None
+
+
+# SHA-1 of the source files of the backtest
+def code_version():
+    global code_version_sha1
+    if code_version_sha1 is None:
+        sha1 = hashlib.sha1()
+        for file_name in CODE_FILES:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name), 'rb') as f:
+                sha1.update(f.read())
+        code_version_sha1 = sha1.hexdigest()
+    return code_version_sha1
+
+
+# Content-addressed store of the backtest results in SQLite: the key is SHA-1 of the dataset fingerprint, the code
+# version and all the params of the run, so the same run is served from the store instead of the backtest.
+# The metrics and the params are the indexed columns of the runs table for the queries, the arrays (the returns and
+# the recording of the orders and the trades) are stored as compressed npz in the arrays table.
+# Every process opens its own store, the writes of the concurrent processes wait for each other.
+class ResultStore:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name, timeout=60)
+        self.hits = 0
+        self.misses = 0
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs ({0})'.format(
+                ', '.join('{0} {1}'.format(name, sql_type) for name, sql_type in RUN_COLUMNS.items())))
+            self.connection.execute('CREATE TABLE IF NOT EXISTS arrays (key TEXT PRIMARY KEY, data BLOB)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS runs_stability ON runs (stability)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS runs_dataset '
+                                    'ON runs (instrument, timeframe, compression, stability)')
+
+    # Params of the run: the dataset, the window of the bars, the engine, the strategy params and the broker settings
+    @staticmethod
+    def make_params(candles, window, engine, algo_params, cash, commission, tf, compression):
+        return {'dataset': candles.fingerprint,
+                'file': os.path.basename(candles.file_data),
+                'instrument': os.path.basename(candles.file_data).split('_')[0],
+                'engine': engine,
+                'code_version': code_version(),
+                'pivot_window_len': int(algo_params['pivot_window_len']),
+                'history_bars_as_multiple_pwl': int(algo_params['history_bars_as_multiple_pwl']),
+                'fixed_tp': float(algo_params['fixed_tp']),
+                'fixed_sl_as_multiple_tp': float(algo_params['fixed_sl_as_multiple_tp']),
+                'cash': float(cash),
+                'commission': float(commission),
+                'timeframe': int(tf),
+                'compression': int(compression),
+                'window_start': int(window[0]) if window is not None else None,
+                'window_stop': int(window[1]) if window is not None else None}
+
+    # Key of the run, the file name isn't a part of it: the dataset is identified by its content
+    @staticmethod
+    def make_key(params):
+        content = {name: value for name, value in params.items() if name not in ('file', 'instrument')}
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    # Stored result of the run: (metrics, arrays), None if there is no such run
+    def get(self, key):
+        row = self.connection.execute('SELECT final_value, total_return, stability, max_drawdown, data '
+                                      'FROM runs JOIN arrays USING (key) WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        final_value, total_return, stability, max_drawdown, data = row
+        with np.load(io.BytesIO(data)) as f:
+            arrays = {name: f[name] for name in f.files}
+        # SQLite stores NaN as NULL
+        metrics = {'final_value': final_value,
+                   'total_return': total_return,
+                   'stability': np.nan if stability is None else stability,
+                   'max_drawdown': max_drawdown}
+        return metrics, arrays
+
+    # Store the result of the run: metrics of final_value, total_return, stability, max_drawdown, trades, runtime
+    # and the arrays, the run stored already is kept
+    def put(self, key, params, metrics, arrays):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        row = dict(params, key=key, created=time.time(), **metrics)
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO runs ({0}) VALUES ({1})'.format(
+                ', '.join(RUN_COLUMNS), ', '.join('?' * len(RUN_COLUMNS))), [row.get(name) for name in RUN_COLUMNS])
+            self.connection.execute('INSERT OR IGNORE INTO arrays VALUES (?, ?)', (key, buffer.getvalue()))
+
+    # Runs matching the conditions as the dataframe of the runs table (without the arrays, see get).
+    # The condition is the value of the column or the range (low, high) of it, None for the open end, e.g.
+    # query(instrument='SBER', timeframe=bt.TimeFrame.Minutes, compression=60, stability=(0.8, None))
+    def query(self, order_by='stability', descending=True, limit=None, **conditions):
+        clauses = []
+        values = []
+        for name, condition in conditions.items():
+            if name not in RUN_COLUMNS:
+                raise ValueError('Unknown column of the runs: {0}'.format(name))
+            if isinstance(condition, (tuple, list)):
+                low, high = condition
+                if low is not None:
+                    clauses.append('{0} >= ?'.format(name))
+                    values.append(low)
+                if high is not None:
+                    clauses.append('{0} <= ?'.format(name))
+                    values.append(high)
+            else:
+                clauses.append('{0} = ?'.format(name))
+                values.append(condition)
+        if order_by not in RUN_COLUMNS:
+            raise ValueError('Unknown column of the runs: {0}'.format(order_by))
+
+        sql = 'SELECT * FROM runs{0} ORDER BY {1} {2}{3}'.format(
+            ' WHERE ' + ' AND '.join(clauses) if clauses else '', order_by, 'DESC' if descending else 'ASC',
+            ' LIMIT {0}'.format(int(limit)) if limit is not None else '')
+        return pd.read_sql_query(sql, self.connection, params=values).set_index('key')
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,144 @@
+from BacktestWorker import init_backtest_worker, worker_backtest
+from IndicatorCache import IndicatorCache
+import backtrader as bt
+import numpy as np
+import pandas as pd
+import itertools
+import multiprocessing
+import time
+
+PARAM_NAMES = ['pivot_window_len', 'history_bars_as_multiple_pwl', 'fixed_tp', 'fixed_sl_as_multiple_tp']
+
+
+# Params matrix of all the combinations of the values of every param (the order of PARAM_NAMES)
+def param_grid(pivot_window_len, history_bars_as_multiple_pwl, fixed_tp, fixed_sl_as_multiple_tp):
+    return np.array(list(itertools.product(pivot_window_len, history_bars_as_multiple_pwl, fixed_tp,
+                                           fixed_sl_as_multiple_tp)), dtype=float).reshape(-1, len(PARAM_NAMES))
+
+
+# Grid around the params (e.g. the PSO optimum): TP & SL within +-relative of them in steps values each,
+# the integer params within +-span of them. The values outside of the bounds lb & ub are dropped.
+def sensitivity_grid(center, relative=0.2, steps=21, pwl_span=2, hbm_span=0, lb=None, ub=None):
+    pwl, hbm, tp, sl = center
+    values = [np.arange(int(pwl) - pwl_span, int(pwl) + pwl_span + 1),
+              np.arange(int(hbm) - hbm_span, int(hbm) + hbm_span + 1),
+              np.linspace(tp * (1.0 - relative), tp * (1.0 + relative), steps),
+              np.linspace(sl * (1.0 - relative), sl * (1.0 + relative), steps)]
+    for i in range(len(values)):
+        if lb is not None:
+            values[i] = values[i][values[i] >= lb[i]]
+        if ub is not None:
+            values[i] = values[i][values[i] <= ub[i]]
+    return param_grid(*values)
+
+
+# Evaluate the chunk of the grid with the same integer params: the indicator is calculated once (or taken from the
+# cache of the worker) and TP & SL of all the points are simulated in one pass over the candles
+def run_grid_chunk(task):
+    rows, params, settings = task
+    start = time.perf_counter()
+    backtest = worker_backtest(window=settings['window'])
+    stabilities, returns = backtest.run_batch(params, cash=settings['cash'], commission=settings['commission'],
+                                              tf=settings['tf'], compression=settings['compression'])
+    return rows, stabilities, returns, time.perf_counter() - start
+
+
+# Evaluation of the grid of params for the sensitivity analysis. The grid is split by the integer params of the
+# indicator, so PivotPointLine is calculated once per distinct pair, and the TP & SL of the pair are simulated
+# together by FastSimulator in chunks of chunk_size points (the values of the chunk are kept in memory).
+# The chunks are evaluated in parallel, the indicator of the pair is reused from the cache of the worker.
+class SensitivityGrid:
+    def __init__(self,
+                 file_data,
+                 grid,
+                 cash=1000,
+                 commission=0.0004,
+                 tf=bt.TimeFrame.Minutes,
+                 compression=60,
+                 window=None,
+                 workers=1,
+                 chunk_size=512,
+                 indicator_cache_size=64,
+                 indicator_cache_dir=None
+                 ):
+        self.file_data = file_data
+        self.grid = np.atleast_2d(np.asarray(grid, dtype=float))
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.indicator_cache_size = indicator_cache_size
+        self.indicator_cache_dir = indicator_cache_dir
+        self.settings = {'cash': cash, 'commission': commission, 'tf': tf, 'compression': compression,
+                         'window': window}
+        self.eval_time = 0.0
+        self.wall_time = 0.0
+
+    # Chunks of the grid rows, the rows of every chunk have the same integer params
+    def tasks(self):
+        groups, group_ind = np.unique(self.grid[:, :2].astype(int), axis=0, return_inverse=True)
+        tasks = []
+        for i in range(len(groups)):
+            rows = np.flatnonzero(group_ind.ravel() == i)
+            for first in range(0, len(rows), self.chunk_size):
+                chunk = rows[first:first + self.chunk_size]
+                tasks.append((chunk, self.grid[chunk], self.settings))
+        return tasks
+
+    # Evaluate all the points, returns the dataframe of the params, the stability and the return of every point
+    def run(self):
+        start = time.perf_counter()
+        tasks = self.tasks()
+        initargs = (self.file_data, IndicatorCache(maxsize=self.indicator_cache_size,
+                                                   cache_dir=self.indicator_cache_dir))
+        if self.workers > 1:
+            # The chunks of one pair are consecutive, so the batches of the pool give them mostly to the same worker
+            with multiprocessing.Pool(processes=self.workers, initializer=init_backtest_worker,
+                                      initargs=initargs) as pool:
+                chunks = pool.map(run_grid_chunk, tasks, chunksize=max(len(tasks) // (4 * self.workers), 1))
+        else:
+            init_backtest_worker(*initargs)
+            chunks = [run_grid_chunk(task) for task in tasks]
+
+        stabilities = np.full(len(self.grid), np.nan)
+        returns = np.full(len(self.grid), np.nan)
+        self.eval_time = 0.0
+        for rows, chunk_stabilities, chunk_returns, chunk_time in chunks:
+            stabilities[rows] = chunk_stabilities
+            returns[rows] = chunk_returns
+            self.eval_time += chunk_time
+        self.wall_time = time.perf_counter() - start
+
+        results = pd.DataFrame(self.grid, columns=PARAM_NAMES)
+        results[PARAM_NAMES[:2]] = results[PARAM_NAMES[:2]].astype(int)
+        results['stability'] = stabilities
+        results['return'] = returns
+        return results
+
+
+# Heatmaps of the value over TP & SL, one for every pair of the integer params.
+# The figure is saved to file_name or shown.
+def plot_sensitivity(results, value='stability', file_name=None):
+    import matplotlib.pyplot as plt
+
+    pairs = results.groupby(PARAM_NAMES[:2], sort=True)
+    columns = min(len(pairs), 3)
+    rows = (len(pairs) + columns - 1) // columns
+    fig, axes = plt.subplots(rows, columns, figsize=(6 * columns, 5 * rows), squeeze=False)
+    vmin, vmax = results[value].min(), results[value].max()
+    for ax, ((pwl, hbm), points) in zip(axes.ravel(), pairs):
+        surface = points.pivot_table(index='fixed_sl_as_multiple_tp', columns='fixed_tp', values=value)
+        image = ax.imshow(surface.values, origin='lower', aspect='auto', cmap='RdYlGn', vmin=vmin, vmax=vmax,
+                          extent=(surface.columns.min(), surface.columns.max(),
+                                  surface.index.min(), surface.index.max()))
+        ax.set_title('pivot_window_len={0}, history_bars_as_multiple_pwl={1}'.format(pwl, hbm))
+        ax.set_xlabel('fixed_tp')
+        ax.set_ylabel('fixed_sl_as_multiple_tp')
+        fig.colorbar(image, ax=ax, label=value)
+    for ax in axes.ravel()[len(pairs):]:
+        ax.set_visible(False)
+    fig.tight_layout()
+
+    if file_name is not None:
+        fig.savefig(file_name)
+        plt.close(fig)
+    else:
+        plt.show()
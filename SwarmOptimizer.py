@@ -0,0 +1,405 @@
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+import numpy as np
+
+
+# Evaluate the objective and measure its CPU time (runs inside the pool workers)
+# CPU time doesn't grow when the workers compete for the cores, so the sum is the serial-equivalent time
+def timed_call(func, x):
+    start = time.process_time()
+    value = func(x)
+    return value, time.process_time() - start
+
+
+# Value and the dict of extra results of the objective, which returns the value or the tuple of both
+def unpack_result(result):
+    return (float(result[0]), result[1]) if isinstance(result, tuple) else (float(result), {})
+
+
+# Particle swarm optimization (the same scheme as pyswarm.pso), which evaluates the whole swarm of each iteration
+# at once, in parallel on the process pool. Random numbers are drawn only in the main process, so the result
+# depends on the seed only and not on the number of workers.
+class SwarmOptimizer:
+    def __init__(self,
+                 func,
+                 lb,
+                 ub,
+                 swarmsize=100,
+                 omega=0.5,
+                 phip=0.5,
+                 phig=0.5,
+                 maxiter=100,
+                 minstep=1e-8,
+                 minfunc=1e-8,
+                 seed=None,
+                 workers=1,
+                 initializer=None,
+                 initargs=(),
+                 batch=False,
+                 journal=None,
+                 time_limit=None,
+                 best_callback=None
+                 ):
+        self.func = func
+        self.lb = np.array(lb, dtype=float)
+        self.ub = np.array(ub, dtype=float)
+        assert len(self.lb) == len(self.ub), 'Lower- and upper-bounds must be the same length'
+        assert np.all(self.ub > self.lb), 'All upper-bound values must be greater than lower-bound values'
+
+        self.swarmsize = swarmsize
+        self.omega = omega
+        self.phip = phip
+        self.phig = phig
+        self.maxiter = maxiter
+        self.minstep = minstep
+        self.minfunc = minfunc
+        self.seed = seed
+        self.workers = workers
+        # Called once in every worker, e.g. for loading the data
+        self.initializer = initializer
+        self.initargs = initargs
+        # func takes the matrix of positions and returns the array of the objectives,
+        # the swarm is split into one chunk per worker
+        self.batch = batch
+        # EvaluationJournal: the evaluations are stored to it and reused, the swarm is checkpointed every iteration
+        self.journal = journal
+        # Soft wall-clock limit of the optimization in seconds: it's checked between the iterations and the search
+        # stops after the iteration exceeding it, so it's overshot by up to one evaluation of the swarm. The swarm
+        # of the iteration is evaluated whole, the positions and the velocities need all its objectives.
+        self.time_limit = time_limit
+        # Called with the objective of the swarm's best known position when it changes, e.g. for Pruner
+        self.best_callback = best_callback
+
+        # Statistics of the last optimization
+        self.evaluations = 0
+        self.journal_hits = 0
+        self.eval_time = 0.0
+        self.wall_time = 0.0
+        self.time_limit_reached = False
+        self.start_time = None
+        # Improvements of the swarm's best objective: (seconds since the start, evaluations, objective)
+        self.history = []
+
+    # Evaluate the objective for every row of positions, the positions known by the journal aren't evaluated again
+    def evaluate(self, pool, positions, iteration=0):
+        if self.journal is None:
+            results = self.call(pool, positions)
+            return np.array([value for value, _, _ in results])
+
+        keys = [self.journal.make_key(x) for x in positions]
+        known = self.journal.lookup(keys)
+        todo = [i for i, key in enumerate(keys) if key not in known and keys.index(key) == i]
+        results = self.call(pool, positions[todo])
+        self.journal.append([(keys[i], positions[i], value, info, elapsed)
+                             for i, (value, info, elapsed) in zip(todo, results)], iteration)
+        self.journal_hits += len(positions) - len(todo)
+
+        known.update((keys[i], (value, info)) for i, (value, info, _) in zip(todo, results))
+        return np.array([known[key][0] for key in keys])
+
+    # Run the objective for the positions, returns (value, info, CPU time) of every one of them
+    # The objective returns the value or the tuple of the value and the dict of extra results for the journal
+    def call(self, pool, positions):
+        call = partial(timed_call, self.func)
+        if len(positions) == 0:
+            return []
+
+        if self.batch:
+            chunks = [chunk for chunk in np.array_split(positions, max(self.workers, 1)) if len(chunk) > 0]
+            chunk_results = [call(chunk) for chunk in chunks] if pool is None else pool.map(call, chunks, chunksize=1)
+            results = []
+            for chunk, (result, elapsed) in zip(chunks, chunk_results):
+                values, info = result if isinstance(result, tuple) else (result, {})
+                for j in range(len(chunk)):
+                    results.append((float(values[j]), {name: float(info[name][j]) for name in info},
+                                    elapsed / len(chunk)))
+        else:
+            results = [call(x) for x in positions] if pool is None else pool.map(call, positions, chunksize=1)
+            results = [unpack_result(result) + (elapsed,) for result, elapsed in results]
+
+        self.evaluations += len(results)
+        self.eval_time += sum(elapsed for _, _, elapsed in results)
+        return results
+
+    # Record the swarm's best objective if it's improved
+    def record(self, fg):
+        if len(self.history) == 0 or fg < self.history[-1][2]:
+            self.history.append((time.perf_counter() - self.start_time, self.evaluations, fg))
+
+    # Seconds and evaluations until the swarm's best objective reached the target, None if it wasn't reached
+    def time_to_target(self, target):
+        for elapsed, evaluations, fg in self.history:
+            if fg <= target:
+                return elapsed, evaluations
+        return None
+
+    # Fraction of the workers' wall-clock time spent in the evaluations (their CPU time). It isn't the speedup over
+    # the serial run: the pool startup, the initializer and IPC aren't in the evaluations.
+    def utilization(self):
+        return self.eval_time / (self.wall_time * max(self.workers, 1)) if self.wall_time > 0 else np.nan
+
+    def optimize(self):
+        self.evaluations = 0
+        self.journal_hits = 0
+        self.eval_time = 0.0
+        self.time_limit_reached = False
+        self.history = []
+        self.start_time = start = time.perf_counter()
+
+        if self.workers > 1:
+            with multiprocessing.Pool(processes=self.workers,
+                                      initializer=self.initializer,
+                                      initargs=self.initargs) as pool:
+                g, fg = self.run(pool)
+        else:
+            if self.initializer is not None:
+                self.initializer(*self.initargs)
+            g, fg = self.run(None)
+
+        self.wall_time = time.perf_counter() - start
+        return g, fg
+
+    # Params of the search, the checkpoint is resumed only by the optimizer with the same ones (maxiter can differ)
+    def config(self):
+        return {'lb': self.lb.tolist(), 'ub': self.ub.tolist(), 'swarmsize': self.swarmsize,
+                'omega': self.omega, 'phip': self.phip, 'phig': self.phig,
+                'minstep': self.minstep, 'minfunc': self.minfunc, 'seed': self.seed}
+
+    def checkpoint(self, rng, it, x, v, p, fp, g, fg, stopped=None):
+        if self.journal is not None:
+            self.journal.save_checkpoint(self.config(), {'iteration': it, 'rng': rng.get_state(),
+                                                         'x': x, 'v': v, 'p': p, 'fp': fp, 'g': g, 'fg': fg,
+                                                         'stopped': stopped})
+
+    def run(self, pool):
+        rng = np.random.RandomState(self.seed)
+        lb, ub = self.lb, self.ub
+        vhigh = np.abs(ub - lb)
+        vlow = -vhigh
+        S, D = self.swarmsize, len(lb)
+
+        state = self.journal.load_checkpoint(self.config()) if self.journal is not None else None
+        if state is not None:
+            # Resume the search after the last checkpointed iteration
+            if state['stopped'] is not None:
+                g, fg, message = state['stopped']
+                print(message)
+                return g, fg
+            print('Resuming the search after iteration {0}'.format(state['iteration']))
+            rng.set_state(state['rng'])
+            start = state['iteration'] + 1
+            x, v, p, fp, g, fg = (state[name] for name in ('x', 'v', 'p', 'fp', 'g', 'fg'))
+        else:
+            start = 1
+            # Initialize the particle's position and velocity
+            x = lb + rng.rand(S, D) * (ub - lb)
+            v = vlow + rng.rand(S, D) * (vhigh - vlow)
+
+            # Particle's best known positions and the swarm's best known position
+            p = x.copy()
+            fp = self.evaluate(pool, x)
+            g = p[0, :].copy()
+            fg = 1e100
+            for i in range(S):
+                if fp[i] < fg:
+                    g = p[i, :].copy()
+                    fg = fp[i]
+            self.checkpoint(rng, 0, x, v, p, fp, g, fg)
+        self.record(fg)
+
+        for it in range(start, self.maxiter + 1):
+            if self.best_callback is not None:
+                self.best_callback(fg)
+            rp = rng.uniform(size=(S, D))
+            rg = rng.uniform(size=(S, D))
+
+            # Update the particles velocity and position, keep them within the bounds
+            v = self.omega * v + self.phip * rp * (p - x) + self.phig * rg * (g - x)
+            x = np.clip(x + v, lb, ub)
+            fx = self.evaluate(pool, x, it)
+
+            # Update the particle's best and the swarm's best known positions
+            for i in range(S):
+                if fx[i] < fp[i]:
+                    p[i, :] = x[i, :]
+                    fp[i] = fx[i]
+                    if fx[i] < fg:
+                        stepsize = np.sqrt(np.sum((g - x[i, :]) ** 2))
+                        message = None
+                        if np.abs(fg - fx[i]) <= self.minfunc:
+                            message = 'Stopping search: Swarm best objective change less than {:}'.format(self.minfunc)
+                        elif stepsize <= self.minstep:
+                            message = 'Stopping search: Swarm best position change less than {:}'.format(self.minstep)
+                        if message is not None:
+                            print(message)
+                            self.checkpoint(rng, it, x, v, p, fp, g, fg, (x[i, :].copy(), fx[i], message))
+                            return x[i, :].copy(), fx[i]
+                        g = x[i, :].copy()
+                        fg = fx[i]
+
+            self.checkpoint(rng, it, x, v, p, fp, g, fg)
+            self.record(fg)
+            if self.time_limit is not None and time.perf_counter() - self.start_time > self.time_limit:
+                # Not recorded as the stop in the checkpoint, the resumed run continues the search
+                self.time_limit_reached = True
+                print('Stopping search: time limit reached --> {:}s'.format(self.time_limit))
+                return g, fg
+
+        print('Stopping search: maximum iterations reached --> {:}'.format(self.maxiter))
+        return g, fg
+
+
+# Asynchronous (steady-state) PSO on the concurrent.futures process pool: every particle is moved and evaluated again
+# as soon as its own evaluation returns, against the swarm's best known position at that moment, so the workers
+# don't wait for the slowest particle of the iteration. The search is stopped by the budget of max_evaluations
+# (swarmsize * (maxiter + 1) by default, the same one as the synchronous search), time_limit or the minstep &
+# minfunc criteria. After the budget is spent the started evaluations are finished; at the time limit the waiting
+# ones are cancelled and only the running ones are finished. The finished ones are taken into account.
+# The order of the evaluations depends on their times, so the result is reproducible by the seed only when workers = 1.
+# The journal stores and reuses the evaluations, but the swarm isn't checkpointed.
+class AsyncSwarmOptimizer(SwarmOptimizer):
+    def __init__(self, func, lb, ub, max_evaluations=None, **kwargs):
+        super().__init__(func, lb, ub, **kwargs)
+        self.max_evaluations = max_evaluations if max_evaluations is not None else self.swarmsize * (self.maxiter + 1)
+
+    def optimize(self):
+        self.evaluations = 0
+        self.journal_hits = 0
+        self.eval_time = 0.0
+        self.time_limit_reached = False
+        self.history = []
+        self.start_time = start = time.perf_counter()
+
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     initializer=self.initializer,
+                                     initargs=self.initargs) as executor:
+                g, fg = self.run(executor)
+        else:
+            if self.initializer is not None:
+                self.initializer(*self.initargs)
+            g, fg = self.run(None)
+
+        self.wall_time = time.perf_counter() - start
+        return g, fg
+
+    # Start the evaluation of the position, the future gives ((value, info), CPU time). Without the executor or for
+    # the position known by the journal the future is done at once.
+    def submit(self, executor, x):
+        if self.journal is not None:
+            known = self.journal.lookup([self.journal.make_key(x)])
+            if known:
+                self.journal_hits += 1
+                future = Future()
+                future.set_result((next(iter(known.values())), None))
+                return future
+
+        # func of the batch mode takes the matrix of positions, the position is copied, it's moved later in place
+        position = x[np.newaxis, :].copy() if self.batch else x.copy()
+        if executor is not None:
+            return executor.submit(timed_call, self.func, position)
+        future = Future()
+        future.set_result(timed_call(self.func, position))
+        return future
+
+    # Objective value of the done evaluation of the position
+    def result(self, future, x, iteration):
+        result, elapsed = future.result()
+        if elapsed is None:
+            return result[0]
+
+        if self.batch:
+            values, info = result if isinstance(result, tuple) else (result, {})
+            value, info = float(values[0]), {name: float(info[name][0]) for name in info}
+        else:
+            value, info = unpack_result(result)
+        self.evaluations += 1
+        self.eval_time += elapsed
+        if self.journal is not None:
+            self.journal.append([(self.journal.make_key(x), x, value, info, elapsed)], iteration)
+        return value
+
+    def run(self, executor):
+        rng = np.random.RandomState(self.seed)
+        lb, ub = self.lb, self.ub
+        vhigh = np.abs(ub - lb)
+        vlow = -vhigh
+        S, D = self.swarmsize, len(lb)
+
+        # Initialize the particle's position and velocity
+        x = lb + rng.rand(S, D) * (ub - lb)
+        v = vlow + rng.rand(S, D) * (vhigh - vlow)
+
+        # Particle's best known positions and the swarm's best known position
+        p = x.copy()
+        fp = np.full(S, np.inf)
+        g = p[0, :].copy()
+        fg = 1e100
+        # Number of the evaluations of every particle, the iteration of the particle in the journal
+        iterations = np.zeros(S, dtype=int)
+
+        pending = {}
+        submitted = 0
+        for i in range(min(S, self.max_evaluations)):
+            pending[self.submit(executor, x[i, :])] = i
+            submitted += 1
+
+        stopping = False
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            # In the order of the submission, so the search without the executor is reproducible by the seed
+            for future in [future for future in pending if future in done]:
+                i = pending.pop(future)
+                fx = self.result(future, x[i, :], iterations[i])
+                iterations[i] += 1
+
+                # Update the particle's best and the swarm's best known positions
+                if fx < fp[i]:
+                    p[i, :] = x[i, :]
+                    fp[i] = fx
+                    if fx < fg:
+                        # The stop criteria apply to the changes of the best known position, not to the first one
+                        message = None
+                        if fg < 1e100:
+                            stepsize = np.sqrt(np.sum((g - x[i, :]) ** 2))
+                            if np.abs(fg - fx) <= self.minfunc:
+                                message = 'Stopping search: Swarm best objective change less than {:}'.format(
+                                    self.minfunc)
+                            elif stepsize <= self.minstep:
+                                message = 'Stopping search: Swarm best position change less than {:}'.format(
+                                    self.minstep)
+                        g = x[i, :].copy()
+                        fg = fx
+                        self.record(fg)
+                        if message is not None:
+                            print(message)
+                            for other in pending:
+                                other.cancel()
+                            return g, fg
+                        if self.best_callback is not None:
+                            self.best_callback(fg)
+
+                if not stopping:
+                    if self.time_limit is not None and time.perf_counter() - self.start_time > self.time_limit:
+                        self.time_limit_reached = stopping = True
+                        print('Stopping search: time limit reached --> {:}s'.format(self.time_limit))
+                        for other in list(pending):
+                            if other.cancel():
+                                del pending[other]
+                    elif submitted >= self.max_evaluations:
+                        stopping = True
+                        print('Stopping search: maximum evaluations reached --> {:}'.format(self.max_evaluations))
+                    else:
+                        # Update the particle's velocity and position against the current best, keep it within
+                        # the bounds
+                        rp = rng.uniform(size=D)
+                        rg = rng.uniform(size=D)
+                        v[i, :] = (self.omega * v[i, :] + self.phip * rp * (p[i, :] - x[i, :]) +
+                                   self.phig * rg * (g - x[i, :]))
+                        x[i, :] = np.clip(x[i, :] + v[i, :], lb, ub)
+                        pending[self.submit(executor, x[i, :])] = i
+                        submitted += 1
+
+        return g, fg
@@ -0,0 +1,131 @@
+from BacktestWorker import init_backtest_worker, worker_backtest, BatchObjective
+from DataCache import load_finam_candles, resample_candles
+from IndicatorCache import IndicatorCache
+from SwarmOptimizer import SwarmOptimizer
+import backtrader as bt
+import numpy as np
+import pandas as pd
+import multiprocessing
+import json
+import os
+import time
+import traceback
+
+# Settings of the job which aren't set in the manifest
+JOB_DEFAULTS = {'timeframe': 'minutes',
+                'compression': 60,
+                'lb': [2, 10, 0.01, 0.1],
+                'ub': [120, 100, 0.2, 1.5],
+                'swarmsize': 20,
+                'maxiter': 40,
+                'seed': None,
+                'time_limit': None,
+                'cash': 1000,
+                'commission': 0.0004}
+
+# Candles of the instruments resampled to the timeframes of the jobs, once per process
+job_candles = {}
+
+
+def timeframe(name):
+    return getattr(bt.TimeFrame, name.capitalize())
+
+
+# Candles of the csv in the timeframe of the job, resampled in memory from the cached candles of the file
+def get_job_candles(file_data, tf, compression):
+    key = (file_data, tf, compression)
+    if key not in job_candles:
+        job_candles[key] = resample_candles(load_finam_candles(file_data), tf, compression)
+    return job_candles[key]
+
+
+# Read the manifest: {"defaults": {...}, "jobs": [{"file": ..., "timeframe": ..., "compression": ..., ...}, ...]}
+# Every job gets the settings of JOB_DEFAULTS, then the defaults of the manifest, then its own ones
+def read_manifest(file_name):
+    with open(file_name) as f:
+        manifest = json.load(f)
+
+    defaults = dict(JOB_DEFAULTS, **manifest.get('defaults', {}))
+    return [dict(defaults, **job) for job in manifest['jobs']]
+
+
+# Estimated cost of the job for the scheduling: bars of the timeframe by the number of evaluations
+# The job with the broken file costs nothing, it fails at once and reports the error
+def job_cost(job):
+    try:
+        candles = get_job_candles(job['file'], timeframe(job['timeframe']), job['compression'])
+    except Exception:
+        return 0
+    return len(candles) * job['swarmsize'] * (job['maxiter'] + 1)
+
+
+# Optimize the strategy params for the job, the errors are reported in the row of the job instead of stopping the sweep
+def run_job(task):
+    ind, job = task
+    start = time.perf_counter()
+    row = {'job': ind,
+           'file': job['file'],
+           'instrument': os.path.basename(job['file']).split('_')[0],
+           'timeframe': job['timeframe'],
+           'compression': job['compression']}
+    try:
+        tf = timeframe(job['timeframe'])
+        candles = get_job_candles(job['file'], tf, job['compression'])
+        backtest = worker_backtest(candles=candles)
+        obj_fun_batch = BatchObjective(backtest, cash=job['cash'], commission=job['commission'],
+                                       tf=tf, compression=job['compression'])
+        optimizer = SwarmOptimizer(obj_fun_batch, job['lb'], job['ub'], swarmsize=job['swarmsize'],
+                                   maxiter=job['maxiter'], seed=job['seed'], batch=True,
+                                   time_limit=job['time_limit'])
+        xopt, fopt = optimizer.optimize()
+        stabilities, returns = backtest.run_batch(xopt, cash=job['cash'], commission=job['commission'],
+                                                  tf=tf, compression=job['compression'])
+
+        row.update({'bars': len(candles),
+                    'status': 'time_limit' if optimizer.time_limit_reached else 'ok',
+                    'pivot_window_len': int(xopt[0]),
+                    'history_bars_as_multiple_pwl': int(xopt[1]),
+                    'fixed_tp': xopt[2],
+                    'fixed_sl_as_multiple_tp': xopt[3],
+                    'stability': stabilities[0],
+                    'return': returns[0],
+                    'evaluations': optimizer.evaluations})
+    except Exception as e:
+        traceback.print_exc()
+        row.update({'status': 'error: {0}'.format(e)})
+
+    row['time'] = time.perf_counter() - start
+    return row
+
+
+# Runs the jobs of the manifest on the local process pool, the longest jobs are started first (LPT scheduling),
+# so the short ones fill the workers at the end of the sweep. The results of all the jobs are joined in one table.
+class SweepRunner:
+    def __init__(self, jobs, workers=1, indicator_cache_size=64, indicator_cache_dir=None):
+        self.jobs = jobs
+        self.workers = workers
+        self.indicator_cache_size = indicator_cache_size
+        self.indicator_cache_dir = indicator_cache_dir
+        self.wall_time = 0.0
+
+    # Jobs in the order of the decreasing cost. The candles are loaded and resampled here, before the pool is forked,
+    # so the workers get them in memory.
+    def schedule(self):
+        costs = [job_cost(job) for job in self.jobs]
+        return [(ind, self.jobs[ind]) for ind in np.argsort(-np.array(costs), kind='stable')]
+
+    def run(self):
+        start = time.perf_counter()
+        tasks = self.schedule()
+        # The candles are loaded per job by get_job_candles, so the workers get only the indicator cache
+        initargs = (None, IndicatorCache(maxsize=self.indicator_cache_size, cache_dir=self.indicator_cache_dir))
+        if self.workers > 1:
+            with multiprocessing.Pool(processes=self.workers, initializer=init_backtest_worker,
+                                      initargs=initargs) as pool:
+                rows = list(pool.imap_unordered(run_job, tasks, chunksize=1))
+        else:
+            init_backtest_worker(*initargs)
+            rows = [run_job(task) for task in tasks]
+
+        self.wall_time = time.perf_counter() - start
+        return pd.DataFrame(rows).set_index('job').sort_index()
@@ -1,5 +1,6 @@
 import backtrader as bt
 from PivotPointLineIndicator import PivotPointLine
+from Instrumentation import staged
 
 # Create a Strategy
 class TrendBreakerPL(bt.Strategy):
@@ -10,7 +11,9 @@ class TrendBreakerPL(bt.Strategy):
         ('fixed_sl_as_multiple_tp', 0.15),
         ('order_full', False),
         ('order_status', False),
-        ('trades', False)
+        ('trades', False),
+        ('indicator_cache', None),
+        ('trade_start', 0)      # Index of the first bar to trade, the bars before it only warm up the indicator
     )
 
     def log(self, txt, dt=None):
@@ -21,7 +24,8 @@ class TrendBreakerPL(bt.Strategy):
     def __init__(self):
         self.pivot_points = PivotPointLine(self.data,
                                            pivot_window_len=self.params.pivot_window_len,
-                                           history_bars_as_multiple_pwl=self.params.history_bars_as_multiple_pwl)
+                                           history_bars_as_multiple_pwl=self.params.history_bars_as_multiple_pwl,
+                                           cache=self.params.indicator_cache)
 
         self.data_open = self.datas[0].open
         self.data_high = self.datas[0].high
@@ -69,7 +73,11 @@ class TrendBreakerPL(bt.Strategy):
             if self.params.order_status:
                 self.log('ORDER STATUS: Partial')
 
+    @staged('strategy_next')
     def next(self):
+        if len(self) <= self.params.trade_start:
+            return
+
         if self.pivot_points.direction[0] == 1.0 and self.position.size == 0.0:
             self.order_target_percent(target=1.0,
                                       exectype=bt.Order.Market)
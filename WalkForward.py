@@ -0,0 +1,130 @@
+from BacktestWorker import init_backtest_worker, worker_backtest, BatchObjective
+from DataCache import load_finam_candles
+from IndicatorCache import IndicatorCache
+from SwarmOptimizer import SwarmOptimizer
+import backtrader as bt
+import numpy as np
+import pandas as pd
+import multiprocessing
+import time
+
+# Train and test windows of the folds as bar ranges of the candles, the windows are whole calendar months.
+# Rolling folds move the train window by test_months, anchored ones extend it from the first month.
+def walk_forward_folds(timestamps, train_months=24, test_months=6, anchored=False):
+    months = np.asarray(timestamps, dtype=np.int64).astype('datetime64[ns]').astype('datetime64[M]')
+    if len(months) == 0:
+        return []
+
+    folds = []
+    first, last = months[0], months[-1]
+    test_start = first + train_months
+    while test_start + test_months <= last + 1:
+        train_start = first if anchored else test_start - train_months
+        bounds = np.searchsorted(months, [train_start, test_start, test_start + test_months])
+        folds.append(((int(bounds[0]), int(bounds[1])), (int(bounds[1]), int(bounds[2]))))
+        test_start += test_months
+
+    return folds
+
+
+# Optimize the params on the train window of the fold and evaluate them on the test window
+def run_fold(task):
+    fold, train, test, settings = task
+    start = time.perf_counter()
+    run_settings = {'cash': settings['cash'], 'commission': settings['commission'], 'tf': settings['tf'],
+                    'compression': settings['compression']}
+
+    backtest = worker_backtest(window=train)
+    obj_fun_batch = BatchObjective(backtest, **run_settings)
+    optimizer = SwarmOptimizer(obj_fun_batch, settings['lb'], settings['ub'],
+                               swarmsize=settings['swarmsize'], maxiter=settings['maxiter'],
+                               seed=settings['seed'], batch=True)
+    xopt, fopt = optimizer.optimize()
+
+    results = {}
+    for name, window in [('train', train), ('test', test)]:
+        stabilities, returns = worker_backtest(window=window).run_batch(xopt, **run_settings)
+        results[name + '_stability'] = stabilities[0]
+        results[name + '_return'] = returns[0]
+
+    timestamp = backtest.candles.timestamp
+    return dict({'fold': fold,
+                 'train_start': pd.Timestamp(timestamp[train[0]]),
+                 'train_end': pd.Timestamp(timestamp[train[1] - 1]),
+                 'test_start': pd.Timestamp(timestamp[test[0]]),
+                 'test_end': pd.Timestamp(timestamp[test[1] - 1]),
+                 'pivot_window_len': int(xopt[0]),
+                 'history_bars_as_multiple_pwl': int(xopt[1]),
+                 'fixed_tp': xopt[2],
+                 'fixed_sl_as_multiple_tp': xopt[3],
+                 'evaluations': optimizer.evaluations,
+                 'time': time.perf_counter() - start}, **results)
+
+
+# Walk-forward optimization of one dataset: the candles are sliced into train/test folds in memory, the folds are
+# optimized in parallel (one fold per process, the swarm of the fold is evaluated in batches by FastSimulator).
+# The indicator is calculated on all the candles, so every window is traded with the indicator warmed up by the bars
+# before it, and the results of it are reused by the folds with the same indicator params.
+class WalkForward:
+    def __init__(self,
+                 file_data,
+                 train_months=24,
+                 test_months=6,
+                 anchored=False,
+                 lb=(2, 10, 0.01, 0.1),
+                 ub=(120, 100, 0.2, 1.5),
+                 swarmsize=20,
+                 maxiter=40,
+                 seed=None,
+                 workers=1,
+                 cash=1000,
+                 commission=0.0004,
+                 tf=bt.TimeFrame.Minutes,
+                 compression=60,
+                 indicator_cache_size=64,
+                 indicator_cache_dir=None
+                 ):
+        self.file_data = file_data
+        self.train_months = train_months
+        self.test_months = test_months
+        self.anchored = anchored
+        self.workers = workers
+        self.indicator_cache_size = indicator_cache_size
+        self.indicator_cache_dir = indicator_cache_dir
+        self.settings = {'lb': list(lb), 'ub': list(ub), 'swarmsize': swarmsize, 'maxiter': maxiter, 'seed': seed,
+                         'cash': cash, 'commission': commission, 'tf': tf, 'compression': compression}
+        self.wall_time = 0.0
+
+    def folds(self):
+        return walk_forward_folds(load_finam_candles(self.file_data).timestamp,
+                                  self.train_months, self.test_months, self.anchored)
+
+    # Run all the folds, returns the report: one row per fold
+    def run(self):
+        start = time.perf_counter()
+        tasks = [(fold, train, test, self.settings) for fold, (train, test) in enumerate(self.folds())]
+        initargs = (self.file_data, IndicatorCache(maxsize=self.indicator_cache_size,
+                                                   cache_dir=self.indicator_cache_dir))
+        if self.workers > 1:
+            with multiprocessing.Pool(processes=self.workers, initializer=init_backtest_worker,
+                                      initargs=initargs) as pool:
+                rows = pool.map(run_fold, tasks, chunksize=1)
+        else:
+            init_backtest_worker(*initargs)
+            rows = [run_fold(task) for task in tasks]
+
+        self.wall_time = time.perf_counter() - start
+        return pd.DataFrame(rows).set_index('fold')
+
+    # Summary of the out-of-sample results and the consensus params (median of the folds)
+    @staticmethod
+    def summary(report):
+        return {'folds': len(report),
+                'test_stability_mean': report['test_stability'].mean(),
+                'test_stability_median': report['test_stability'].median(),
+                'test_profitable_folds': int((report['test_return'] > 0).sum()),
+                'test_compound_return': (1.0 + report['test_return']).prod() - 1.0,
+                'pivot_window_len': int(report['pivot_window_len'].median()),
+                'history_bars_as_multiple_pwl': int(report['history_bars_as_multiple_pwl'].median()),
+                'fixed_tp': report['fixed_tp'].median(),
+                'fixed_sl_as_multiple_tp': report['fixed_sl_as_multiple_tp'].median()}
@@ -0,0 +1,72 @@
+from SwarmOptimizer import SwarmOptimizer, AsyncSwarmOptimizer
+from IndicatorCache import IndicatorCache
+import main
+import numpy as np
+import pandas as pd
+import argparse
+import contextlib
+import io
+import json
+import warnings
+warnings.filterwarnings("ignore")
+
+# Time to the target stability of the synchronous PSO (every iteration waits for the slowest particle) and of the
+# asynchronous steady-state one, with the same budget of evaluations, seeds and workers. The particles are evaluated
+# one by one in both modes, so the difference is the scheduling only.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time to the target stability of the synchronous and asynchronous PSO')
+    parser.add_argument('--target', type=float, default=0.9, help='target stability')
+    parser.add_argument('--workers', type=int, default=4, help='number of processes evaluating the swarm')
+    parser.add_argument('--swarmsize', type=int, default=16, help='number of particles in the swarm')
+    parser.add_argument('--maxiter', type=int, default=10,
+                        help='maximum number of iterations, the budget of evaluations is swarmsize * (maxiter + 1)')
+    parser.add_argument('--seeds', default='0,1,2', help='seeds of the runs of every mode')
+    parser.add_argument('--engine', choices=['fast', 'cerebro'], default='fast', help='engine of the evaluations')
+    parser.add_argument('--indicator-cache-size', type=int, default=0,
+                        help='number of PivotPointLine results kept by every worker (0: every evaluation '
+                             'calculates the indicator, as the new params do)')
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    args = parser.parse_args()
+
+    # Bounds for parameters space
+    lb = [2, 10, 0.01, 0.1]
+    ub = [120, 100, 0.2, 1.5]
+
+    cache = IndicatorCache(maxsize=args.indicator_cache_size) if args.indicator_cache_size > 0 else None
+    rows = []
+    for seed in [int(seed) for seed in args.seeds.split(',')]:
+        for mode, optimizer_class in [('sync', SwarmOptimizer), ('async', AsyncSwarmOptimizer)]:
+            optimizer = optimizer_class(main.obj_fun, lb, ub, swarmsize=args.swarmsize, maxiter=args.maxiter,
+                                        seed=seed, workers=args.workers, initializer=main.init_worker,
+                                        initargs=(main.train_file, cache, args.engine), minfunc=0.0, minstep=0.0)
+            # The objective prints every evaluation (the workers are forked inside, so their output is caught too)
+            with contextlib.redirect_stdout(io.StringIO()):
+                xopt, fopt = optimizer.optimize()
+            reached = optimizer.time_to_target(-args.target)
+            rows.append({'seed': seed,
+                         'mode': mode,
+                         'time_to_target': reached[0] if reached is not None else np.nan,
+                         'evaluations_to_target': reached[1] if reached is not None else np.nan,
+                         'best_stability': -fopt,
+                         'evaluations': optimizer.evaluations,
+                         'wall_time': optimizer.wall_time,
+                         'utilization': optimizer.utilization()})
+            print('seed {seed} {mode:5}: time to target {time_to_target:8.2f}s, evaluations {evaluations_to_target}, '
+                  'best stability {best_stability:.4f}, wall-clock time {wall_time:.2f}s, '
+                  'utilization of the workers {utilization:.0%}'.format(**rows[-1]))
+
+    results = pd.DataFrame(rows)
+    summary = results.groupby('mode').agg(runs=('seed', 'size'),
+                                          reached=('time_to_target', 'count'),
+                                          time_to_target=('time_to_target', 'median'),
+                                          evaluations_to_target=('evaluations_to_target', 'median'),
+                                          best_stability=('best_stability', 'median'),
+                                          wall_time=('wall_time', 'median'),
+                                          utilization=('utilization', 'median'))
+    with pd.option_context('display.width', 250, 'display.max_columns', None):
+        print(summary)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'runs': rows}, f, indent=2)
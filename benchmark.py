@@ -0,0 +1,254 @@
+from BacktestTrendBreakerPL import BacktestTrendBreakerPL
+from DataCache import FinamCandles, load_finam_candles
+from DataFeedFormat import read_finam_csv
+from FastSimulator import simulate, period_ids, period_returns, DAY_NS
+from PivotPointLineIndicator import pivot_point_line
+from SwarmOptimizer import SwarmOptimizer
+import main
+import backtrader as bt
+import numpy as np
+import multiprocessing
+import argparse
+import datetime
+import platform
+import resource
+import contextlib
+import io
+import json
+import time
+import sys
+import warnings
+warnings.filterwarnings("ignore")
+
+# Benchmarks of the indicator, the strategy and the optimizer on the bundled datasets and synthetic series.
+# Every case runs in the fresh process, so its peak RSS isn't affected by the other cases.
+# Results are written as JSON and compared with the baseline: the run fails if any case became slower than allowed.
+
+train_file = './data/SBER_140101_171231_hourly_train.csv'
+files = [train_file,
+         './data/SBER_180101_200224_hourly_test.csv',
+         './data/SBER_140101_200224_hourly_full.csv']
+
+output_settings = {'order_full': False,
+                   'order_status': False,
+                   'trades': False,
+                   'performance': False,
+                   'plot': False
+                   }
+
+algo_params = {'pivot_window_len': 12,
+               'history_bars_as_multiple_pwl': 30,
+               'fixed_tp': 0.08,
+               'fixed_sl_as_multiple_tp': 0.15,
+               }
+
+
+# Random walk hourly candles with the same columns as the cached Finam candles
+def synthetic_candles(num_bars, seed=0):
+    rng = np.random.RandomState(seed)
+    close = 100.0 * np.exp(np.cumsum(rng.normal(0.0, 0.005, num_bars)))
+    open = np.concatenate(([100.0], close[:-1]))
+    spread = np.abs(rng.normal(0.0, 0.003, (2, num_bars))) * close
+    timestamp = np.datetime64('2000-01-03T10:00', 'ns').astype(np.int64) + np.arange(num_bars) * (DAY_NS // 24)
+    columns = {'timestamp': timestamp,
+               'datetime': timestamp / DAY_NS + bt.date2num(datetime.datetime(1970, 1, 1)),
+               'open': open,
+               'high': np.maximum(open, close) + spread[0],
+               'low': np.minimum(open, close) - spread[1],
+               'close': close,
+               'volume': rng.randint(1, 1000, num_bars).astype(float)}
+    return FinamCandles(None, 'synthetic-{0}-{1}'.format(num_bars, seed), columns)
+
+
+def get_candles(source):
+    return synthetic_candles(int(source)) if source.isdigit() else load_finam_candles(source)
+
+
+# Cases: the setup isn't timed, it returns the function to time
+
+def case_csv_load(source):
+    return lambda: read_finam_csv(source)
+
+
+def case_cache_load(source):
+    load_finam_candles(source)
+    return lambda: np.asarray(load_finam_candles(source).close).sum()
+
+
+def case_indicator(source, pivot_window_len, history_bars_as_multiple_pwl):
+    candles = get_candles(source)
+    return lambda: pivot_point_line(candles.open, candles.high, candles.low, candles.close,
+                                    pivot_window_len=pivot_window_len,
+                                    history_bars_as_multiple_pwl=history_bars_as_multiple_pwl)
+
+
+def case_strategy(source, engine):
+    candles = get_candles(source)
+
+    def run():
+        backtest = BacktestTrendBreakerPL(file_data=source, algo_params=algo_params,
+                                          output_settings=output_settings, candles=candles)
+        backtest.run_strategy(cash=1000, commission=0.0004, tf=bt.TimeFrame.Minutes, compression=60, engine=engine)
+
+    return run
+
+
+def case_simulator(source):
+    candles = get_candles(source)
+    direction = pivot_point_line(candles.open, candles.high, candles.low, candles.close,
+                                 pivot_window_len=12, history_bars_as_multiple_pwl=30)[3]
+    return lambda: simulate(candles.open, candles.high, candles.low, candles.close, direction,
+                            fixed_tp=0.08, fixed_sl_as_multiple_tp=0.15)
+
+
+def case_analyzer(source):
+    candles = get_candles(source)
+    backtest = BacktestTrendBreakerPL(file_data=source, algo_params=algo_params,
+                                      output_settings=output_settings, candles=candles)
+    direction = pivot_point_line(candles.open, candles.high, candles.low, candles.close,
+                                 pivot_window_len=12, history_bars_as_multiple_pwl=30)[3]
+    values, _, _ = simulate(candles.open, candles.high, candles.low, candles.close, direction,
+                            fixed_tp=0.08, fixed_sl_as_multiple_tp=0.15)
+
+    def run():
+        ids = period_ids(candles.timestamp, bt.TimeFrame.Minutes, 60)
+        return backtest.stability_of_timeseries(period_returns(values, ids, 1000)[1])
+
+    return run
+
+
+def case_pso_iteration(swarmsize, engine):
+    main.init_worker(train_file, None, engine)
+    batch = engine == 'fast'
+
+    def run():
+        optimizer = SwarmOptimizer(main.obj_fun_batch if batch else main.obj_fun,
+                                   [2, 10, 0.01, 0.1], [120, 100, 0.2, 1.5],
+                                   swarmsize=swarmsize, maxiter=1, seed=0, batch=batch)
+        # The objective prints every evaluation
+        with contextlib.redirect_stdout(io.StringIO()):
+            optimizer.optimize()
+
+    return run
+
+
+CASES = {'csv_load': case_csv_load,
+         'cache_load': case_cache_load,
+         'indicator': case_indicator,
+         'strategy': case_strategy,
+         'simulator': case_simulator,
+         'analyzer': case_analyzer,
+         'pso_iteration': case_pso_iteration}
+
+
+# All the cases of the suite as (name, case, kwargs)
+def suite(sizes):
+    cases = []
+    for file in files:
+        cases.append(('csv_load:' + file, 'csv_load', {'source': file}))
+        cases.append(('cache_load:' + file, 'cache_load', {'source': file}))
+    for pivot_window_len in [2, 12, 37, 120]:
+        for history_bars_as_multiple_pwl in [10, 30, 100]:
+            cases.append(('indicator:{0}:{1}:{2}'.format(train_file, pivot_window_len, history_bars_as_multiple_pwl),
+                          'indicator', {'source': train_file, 'pivot_window_len': pivot_window_len,
+                                        'history_bars_as_multiple_pwl': history_bars_as_multiple_pwl}))
+    for size in sizes:
+        cases.append(('indicator:synthetic-{0}:12:30'.format(size), 'indicator',
+                      {'source': str(size), 'pivot_window_len': 12, 'history_bars_as_multiple_pwl': 30}))
+        cases.append(('simulator:synthetic-{0}'.format(size), 'simulator', {'source': str(size)}))
+        cases.append(('analyzer:synthetic-{0}'.format(size), 'analyzer', {'source': str(size)}))
+    for engine in ['cerebro', 'fast']:
+        cases.append(('strategy:{0}:{1}'.format(train_file, engine), 'strategy',
+                      {'source': train_file, 'engine': engine}))
+        # One iteration of the swarm in main.py, smaller for cerebro
+        swarmsize = 20 if engine == 'fast' else 4
+        cases.append(('pso_iteration:{0}:{1}'.format(swarmsize, engine), 'pso_iteration',
+                      {'swarmsize': swarmsize, 'engine': engine}))
+    # The out-of-core run reads the candles from the cache in blocks
+    cases.append(('strategy:{0}:chunked'.format(train_file), 'strategy', {'source': train_file, 'engine': 'chunked'}))
+
+    return cases
+
+
+# Peak resident set size of the process in MB (ru_maxrss is in KB on Linux and in bytes on macOS)
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+# Run the case: one untimed warm up call (numba compilation, disk cache), then the timed repeats
+def run_case(case, kwargs, repeats):
+    warnings.filterwarnings("ignore")
+    rss_start = peak_rss_mb()
+    func = CASES[case](**kwargs)
+    func()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return {'min': min(times),
+            'median': float(np.median(times)),
+            'repeats': repeats,
+            'peak_rss_mb': peak_rss_mb(),
+            'rss_start_mb': rss_start}
+
+
+# Compare the results with the baseline, returns the list of (name, ratio) of the cases slower than allowed
+def compare(results, baseline, max_slowdown):
+    slow = []
+    for name, result in results.items():
+        if name in baseline:
+            ratio = result['median'] / baseline[name]['median']
+            if ratio > max_slowdown:
+                slow.append((name, ratio))
+    return slow
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the indicator, the strategy and the optimizer')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file for the results')
+    parser.add_argument('--baseline', default=None, help='JSON file of the previous run to compare with')
+    parser.add_argument('--max-slowdown', type=float, default=1.5,
+                        help='fail if the median time of any case grows more than this factor over the baseline')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='sizes of the synthetic series, in bars')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs of every case')
+    parser.add_argument('--filter', default='', help='run only the cases containing this substring')
+    parser.add_argument('--in-process', action='store_true',
+                        help='run all the cases in this process (faster, but peak RSS is cumulative)')
+    args = parser.parse_args()
+
+    cases = [c for c in suite([int(size) for size in args.sizes.split(',') if size]) if args.filter in c[0]]
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name, case, kwargs in cases:
+        if args.in_process:
+            result = run_case(case, kwargs, args.repeats)
+        else:
+            with context.Pool(processes=1) as pool:
+                result = pool.apply(run_case, (case, kwargs, args.repeats))
+        results[name] = result
+        print('{0:70} {1:10.4f}s {2:10.4f}s {3:8.1f} MB'.format(name, result['min'], result['median'],
+                                                               result['peak_rss_mb']))
+
+    report = {'meta': {'time': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'numpy': np.__version__,
+                       'backtrader': bt.__version__,
+                       'repeats': args.repeats},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results are written to ' + args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        slow = compare(results, baseline, args.max_slowdown)
+        for name, ratio in slow:
+            print('SLOWER {0}: {1:.2f}x of the baseline'.format(name, ratio))
+        print('Slower than {0:.2f}x of the baseline: {1} of {2} cases'.format(args.max_slowdown, len(slow),
+                                                                            len(results)))
+        exit(1 if slow else 0)
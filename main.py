@@ -1,77 +1,274 @@
 from BacktestTrendBreakerPL import BacktestTrendBreakerPL
+from BacktestWorker import init_backtest_worker, worker_backtest, BatchObjective
+from DataCache import load_finam_candles
+from IndicatorCache import IndicatorCache
+from SwarmOptimizer import SwarmOptimizer, AsyncSwarmOptimizer
+import BacktestWorker
+from EvaluationJournal import EvaluationJournal
+from Pruner import Pruner
+from Instrumentation import EvaluationProfiler
+from ResultStore import ResultStore
+import os
 import backtrader as bt
+import argparse
+import contextlib
+import io
 import warnings
 warnings.filterwarnings("ignore")
 
-from pyswarm import pso
+# Train candles, memory-mapped once per worker process (see BacktestWorker)
+train_file = './data/SBER_140101_171231_hourly_train.csv'
+engine = 'fast'
+pruner = None
+profiler = None
+result_store = None
+
+
+# Initialization of the worker process for the optimization
+# profile_settings are the args of EvaluationProfiler: (profile_dir, slowest, profiler, track_allocations)
+def init_worker(file_data, cache, backtest_engine, backtest_pruner=None, profile_settings=None, results_file=None):
+    global engine, pruner, profiler, result_store
+    init_backtest_worker(file_data, cache, jit=backtest_engine == 'fast')
+    engine = backtest_engine
+    pruner = backtest_pruner
+    profiler = EvaluationProfiler(*profile_settings) if profile_settings is not None else None
+    result_store = ResultStore(results_file) if results_file is not None else None
+
 
 # The objective function for optimization
 def obj_fun(x):
-    print('')
-    print('Launched the iteration with ' + str(x))
-
     ap = {'pivot_window_len': int(x[0]),
           'history_bars_as_multiple_pwl': int(x[1]),
           'fixed_tp': x[2],
           'fixed_sl_as_multiple_tp': x[3]
           }
-    os = {'order_full': False,
-          'order_status': False,
-          'trades': False,
-          'performance': True,
-          'plot': False
-          }
 
     # Creater object for Backtesting
-    backtest = BacktestTrendBreakerPL(file_data='./SBER_140101_171231_hourly_train.csv',
-                                      algo_params=ap,
-                                      output_settings=os)
+    backtest = worker_backtest(algo_params=ap,
+                               instrumentation=profiler.instrumentation if profiler is not None else None,
+                               result_store=result_store)
     # Run the strategy (hourly timeframe)
-    backtest.run_strategy(cash=1000,
-                          commission=0.0004,
-                          tf=bt.TimeFrame.Minutes,
-                          compression=60)
+    run = lambda: backtest.run_strategy(cash=1000,
+                                        commission=0.0004,
+                                        tf=bt.TimeFrame.Minutes,
+                                        compression=60,
+                                        engine=engine)
+    result = profiler.run(run) if profiler is not None else run()
+    print('Launched the iteration with ' + str(x) + ', stability: ' + str(result.stability))
 
-    # Add "minus" for minimization
-    return -backtest.stability
+    # Add "minus" for minimization, the stability and the return are stored to the journal
+    return -result.stability, {'stability': result.stability, 'return': result.total_return}
 
 
-# Bounds for parameters space
-lb = [2, 10, 0.01, 0.1]
-ub = [120, 100, 0.2, 1.5]
+# The objective function for the whole swarm at once (fast engine only)
+def obj_fun_batch(positions):
+    backtest = worker_backtest(instrumentation=profiler.instrumentation if profiler is not None else None,
+                               result_store=result_store)
+    objective = BatchObjective(backtest,
+                               cash=1000,
+                               commission=0.0004,
+                               tf=bt.TimeFrame.Minutes,
+                               compression=60,
+                               pruner=pruner)
+    values, info = profiler.run(objective, positions) if profiler is not None else objective(positions)
+    for x, stability, pruned in zip(positions, info['stability'], backtest.pruned):
+        print('Launched the iteration with ' + str(x) + ', stability: ' + str(stability) + (' (pruned)' if pruned else ''))
 
-# Run the optimization
-xopt, fopt = pso(obj_fun, lb, ub, swarmsize=20, maxiter=40)
-print('OPTIMAL PARAMETERS:')
-print(xopt, fopt)
+    # Minus the stabilities for minimization, the stabilities and the returns are stored to the journal
+    return values, info
 
-# Store the best params
-algo_params = {'pivot_window_len': int(xopt[0]),
-               'history_bars_as_multiple_pwl': int(xopt[1]),
-               'fixed_tp': xopt[2],
-               'fixed_sl_as_multiple_tp': xopt[3],
-               }
 
-output_settings = {'order_full': False,
-                   'order_status': False,
-                   'trades': False,
-                   'performance': True,
-                   'plot': True
+# Measured wall-clock speedup of the workers: the first iterations of the same swarm (the same seed gives the same
+# positions) are run serially and on the pool, with the pool startup, the initializer and IPC included.
+# Both runs get their own indicator cache in memory and no journal, result store, pruner or profiler.
+# An untimed serial run goes first, so the compilation and the loading of the modules are paid before the timed runs
+# and both of them (the pool is forked from this process) start warm. The serial runs initialize this process as
+# the worker, its state of the optimization is restored after them.
+def measure_speedup(optimizer_class, func, lb, ub, settings, iterations, cache_size):
+    global engine, pruner, profiler, result_store
+    state = (engine, pruner, profiler, result_store, BacktestWorker.worker_candles,
+             BacktestWorker.worker_indicator_cache)
+
+    def run(workers):
+        initargs = (train_file, IndicatorCache(maxsize=cache_size), settings['initargs'][2])
+        run_settings = dict(settings, maxiter=iterations, workers=workers, initargs=initargs, journal=None,
+                            time_limit=None, best_callback=None)
+        if 'max_evaluations' in run_settings:
+            # The budget of the asynchronous search follows the iterations
+            run_settings['max_evaluations'] = None
+        optimizer = optimizer_class(func, lb, ub, **run_settings)
+        # The objective prints every evaluation
+        with contextlib.redirect_stdout(io.StringIO()):
+            optimizer.optimize()
+        return optimizer.wall_time
+
+    try:
+        run(1)
+        return run(1), run(settings['workers'])
+    finally:
+        engine, pruner, profiler, result_store, BacktestWorker.worker_candles, \
+            BacktestWorker.worker_indicator_cache = state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PSO of the TrendBreakerPL strategy parameters')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes evaluating the swarm')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the swarm random numbers')
+    parser.add_argument('--swarmsize', type=int, default=20, help='number of particles in the swarm')
+    parser.add_argument('--maxiter', type=int, default=40, help='maximum number of iterations')
+    parser.add_argument('--async', dest='asynchronous', action='store_true',
+                        help='steady-state PSO: every particle is moved as soon as its own evaluation returns')
+    parser.add_argument('--max-evaluations', type=int, default=None,
+                        help='budget of the evaluations of the asynchronous search (swarmsize * (maxiter + 1) by default)')
+    parser.add_argument('--time-limit', type=float, default=None,
+                        help='soft wall-clock limit of the search in seconds: the synchronous search checks it between '
+                             'the iterations, so it can be overshot by one iteration')
+    parser.add_argument('--measure-speedup', type=int, default=0, metavar='ITERATIONS',
+                        help='after the optimization, run this number of iterations of the same swarm serially and '
+                             'on the workers and report the wall-clock speedup')
+    parser.add_argument('--engine', choices=['fast', 'cerebro'], default='fast',
+                        help='FastSimulator or the full backtrader run for the evaluations')
+    parser.add_argument('--no-batch', action='store_true',
+                        help='evaluate the particles one by one instead of the batch run of the fast engine')
+    parser.add_argument('--indicator-cache-size', type=int, default=64,
+                        help='number of PivotPointLine results kept in memory by every worker')
+    parser.add_argument('--indicator-cache-dir', default=None,
+                        help='directory for PivotPointLine results shared by the workers on disk')
+    parser.add_argument('--journal', default=None,
+                        help='SQLite file of the evaluations and the swarm checkpoint, the run is resumed from it')
+    parser.add_argument('--prune-min-stability', type=float, default=None,
+                        help='heuristic: stop the backtests with the stability below this value at the checkpoints '
+                             '(not a bound on the final stability, the search can get worse)')
+    parser.add_argument('--prune-margin', type=float, default=None,
+                        help='heuristic: stop the backtests with the stability below the best one by more than this '
+                             'margin (not a bound on the final stability, the search can get worse)')
+    parser.add_argument('--prune-max-drawdown', type=float, default=None,
+                        help='exact: stop the backtests with the drawdown deeper than this fraction, they break '
+                             'the drawdown limit whatever the rest of the bars')
+    parser.add_argument('--prune-checkpoints', default='0.25,0.5,0.75',
+                        help='fractions of the bars where the backtests are checked for pruning')
+    parser.add_argument('--results', default=None,
+                        help='SQLite store of the backtest results, the same runs are served from it '
+                             '(the evaluations one by one, the completed batch evaluations and the final runs)')
+    parser.add_argument('--profile-dir', default=None,
+                        help='directory for the time, calls and allocations of the backtest stages of all the evaluations')
+    parser.add_argument('--profile-slowest', type=int, default=0,
+                        help='keep the profiles of this number of the slowest evaluations in the profile directory '
+                             '(every evaluation runs under the profiler)')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile',
+                        help='profiler of the slowest evaluations')
+    parser.add_argument('--profile-allocations', action='store_true',
+                        help='trace the allocations of the stages with tracemalloc (slow)')
+    args = parser.parse_args()
+
+    # Bounds for parameters space
+    lb = [2, 10, 0.01, 0.1]
+    ub = [120, 100, 0.2, 1.5]
+
+    # Build the binary cache of the candles before the workers map it
+    load_finam_candles(train_file)
+
+    # Results of the indicator are reused by the particles with the same integer params
+    cache = IndicatorCache(maxsize=args.indicator_cache_size, cache_dir=args.indicator_cache_dir, shared=True)
+
+    # Hopeless evaluations are stopped early by the batch run of the fast engine
+    batch = args.engine == 'fast' and not args.no_batch
+    pruner = None
+    if args.prune_min_stability is not None or args.prune_margin is not None or args.prune_max_drawdown is not None:
+        if not batch:
+            parser.error('the pruning needs the batch run of the fast engine (no --engine cerebro or --no-batch)')
+        pruner = Pruner(checkpoints=[float(fraction) for fraction in args.prune_checkpoints.split(',')],
+                        min_stability=args.prune_min_stability,
+                        best_margin=args.prune_margin,
+                        max_drawdown=args.prune_max_drawdown,
+                        shared=True)
+
+    # The objective values of the journal depend on the pruning, the journal of the other prune settings isn't reused
+    journal = EvaluationJournal(args.journal) if args.journal else None
+    if journal is not None and not journal.check_settings({'pruner': pruner.config() if pruner is not None else None}):
+        parser.error('the journal {0} is made with the other prune settings'.format(args.journal))
+
+    # Stages of the evaluations are summed by every worker and joined after the optimization
+    profile_settings = None
+    if args.profile_dir is not None:
+        os.makedirs(args.profile_dir, exist_ok=True)
+        EvaluationProfiler.reset(args.profile_dir)
+        profile_settings = (args.profile_dir, args.profile_slowest, args.profiler, args.profile_allocations)
+
+    # Run the optimization, the asynchronous one evaluates the particles one by one (batches of one particle)
+    settings = {'swarmsize': args.swarmsize,
+                'maxiter': args.maxiter,
+                'seed': args.seed,
+                'workers': args.workers,
+                'initializer': init_worker,
+                'initargs': (train_file, cache, args.engine, pruner, profile_settings, args.results),
+                'batch': batch,
+                'journal': journal,
+                'time_limit': args.time_limit,
+                'best_callback': (lambda fg: pruner.set_best(-fg)) if pruner is not None else None}
+    if args.asynchronous:
+        settings['max_evaluations'] = args.max_evaluations
+    optimizer_class = AsyncSwarmOptimizer if args.asynchronous else SwarmOptimizer
+    optimizer = optimizer_class(obj_fun_batch if batch else obj_fun, lb, ub, **settings)
+    xopt, fopt = optimizer.optimize()
+    print('OPTIMAL PARAMETERS:')
+    print(xopt, fopt)
+    print('Evaluations: {0}, backtests CPU time: {1:.1f}s, wall-clock time: {2:.1f}s, '
+          'worker utilization: {3:.0%} on {4} workers'.format(optimizer.evaluations, optimizer.eval_time,
+                                                             optimizer.wall_time, optimizer.utilization(),
+                                                             args.workers))
+    if args.measure_speedup > 0:
+        serial_time, parallel_time = measure_speedup(optimizer_class, obj_fun_batch if batch else obj_fun, lb, ub,
+                                                     settings, args.measure_speedup, args.indicator_cache_size)
+        print('Speedup: {0:.2f}x on {1} workers ({2} iterations: {3:.1f}s serially, {4:.1f}s on the workers)'.format(
+            serial_time / parallel_time, args.workers, args.measure_speedup, serial_time, parallel_time))
+    if args.journal:
+        print('Journal: {0} evaluations reused, {1} stored'.format(optimizer.journal_hits, len(optimizer.journal)))
+    if pruner is not None:
+        stats = pruner.stats()
+        print('Pruning: {completed} evaluations completed, {pruned} pruned, {skipped_fraction:.1%} of the bars skipped, '
+              'about {time_saved:.2f}s of the simulation time saved'.format(**stats) +
+              (' (heuristic rules, the best result can be missed)' if pruner.heuristic else ''))
+    print('Indicator cache: {hits} hits in memory, {disk_hits} hits on disk, {misses} misses'.format(**cache.stats()))
+    if args.profile_dir is not None:
+        instrumentation, profiles = EvaluationProfiler.collect(args.profile_dir, args.profile_slowest)
+        instrumentation.save_json(os.path.join(args.profile_dir, 'stages.json'))
+        instrumentation.save_collapsed(os.path.join(args.profile_dir, 'stages.collapsed'))
+        print('Stages of the evaluations:')
+        for name, (calls, seconds, alloc_bytes) in sorted(instrumentation.by_name().items(), key=lambda item: -item[1][1]):
+            print('  {0:<16} {1:>9} calls {2:>9.3f}s {3:>12} bytes'.format(name, calls, seconds, alloc_bytes))
+        for file_name in profiles:
+            print('Profile of the slow evaluation: ' + file_name)
+
+    # Store the best params
+    algo_params = {'pivot_window_len': int(xopt[0]),
+                   'history_bars_as_multiple_pwl': int(xopt[1]),
+                   'fixed_tp': xopt[2],
+                   'fixed_sl_as_multiple_tp': xopt[3],
                    }
 
-# Run the strategy with best params
-# Using train, test and full datasets
-for file in ['./data/SBER_140101_171231_hourly_train.csv',
-          './data/SBER_180101_200224_hourly_test.csv',
-          './data/SBER_140101_200224_hourly_full.csv']:
-    print('Launched backtest for ' + file)
-    backtest = BacktestTrendBreakerPL(file_data=file,
-                                      algo_params=algo_params,
-                                      output_settings=output_settings)
-    backtest.run_strategy(cash=1000,
-                          commission=0.0004,
-                          tf=bt.TimeFrame.Minutes,
-                          compression=60)
+    output_settings = {'order_full': False,
+                       'order_status': False,
+                       'trades': False,
+                       'performance': True,
+                       'plot': True
+                       }
+
+    # Run the strategy with best params
+    # Using train, test and full datasets
+    store = ResultStore(args.results) if args.results else None
+    for file in ['./data/SBER_140101_171231_hourly_train.csv',
+                 './data/SBER_180101_200224_hourly_test.csv',
+                 './data/SBER_140101_200224_hourly_full.csv']:
+        print('Launched backtest for ' + file)
+        backtest = BacktestTrendBreakerPL(file_data=file,
+                                          algo_params=algo_params,
+                                          output_settings=output_settings,
+                                          result_store=store)
+        backtest.run_strategy(cash=1000,
+                              commission=0.0004,
+                              tf=bt.TimeFrame.Minutes,
+                              compression=60)
 
 
 
@@ -0,0 +1,328 @@
+from BacktestTrendBreakerPL import BacktestTrendBreakerPL
+from DataCache import load_finam_candles, resample_candles, BLOCK_SIZE
+from DataFeedFormat import FinamArrays
+from PivotPointLineIndicator import PivotPointLine, PivotPointLineStream, pivot_point_line_lines
+import FastSimulator
+import backtrader as bt
+import numpy as np
+import pandas as pd
+import argparse
+import time
+import warnings
+warnings.filterwarnings("ignore")
+
+# Parity checks of the fast paths with the reference ones on the bundled datasets, every check prints one line
+# per case and the script fails if any case mismatches:
+#   engines   - FastSimulator with cerebro: final value, stability and TimeReturn series
+#   windows   - the engines (the chunked one with several block sizes) on the windows of the bars, the indicator
+#               warmed up by the bars before the window
+#   resampled - the engines on the candles resampled to 4 hours, on all the bars and on a window
+#   indicator - pivot_point_line with the slow bar by bar implementation it replaced, bit for bit
+#   next      - PivotPointLine bar by bar (runonce=False) with the batch once (runonce=True) in cerebro, and
+#               PivotPointLineStream with pivot_point_line on random candles with many ties
+
+files = ['./data/SBER_140101_171231_hourly_train.csv',
+         './data/SBER_180101_200224_hourly_test.csv',
+         './data/SBER_140101_200224_hourly_full.csv']
+
+# pivot_window_len, history_bars_as_multiple_pwl, fixed_tp, fixed_sl_as_multiple_tp
+params = [(12, 30, 0.08, 0.15),
+          (2, 10, 0.01, 0.1),
+          (5, 40, 0.05, 1.2),
+          (37, 13, 0.2, 1.5),
+          (20, 50, 0.03, 0.5),
+          (8, 12, 0.12, 0.3)]
+
+# Windows [start, stop) of the bars of the full dataset for the windows check
+window_file = files[2]
+windows = [(5000, 13904), (100, 3000), (7000, 9000)]
+
+# Engines of the windows checks: the chunked one with the blocks shorter than the indicator history, of an odd size
+# and of the default size, as 'chunked/<block size>'
+window_engines = ['cerebro', 'fast'] + ['chunked/{0}'.format(size) for size in (500, 4093, BLOCK_SIZE)]
+
+# Compression (minutes) of the resampled check and its windows, None is all the bars
+resampled_compression = 240
+resampled_windows = [None, (1200, 3400)]
+
+# pivot_window_len, history_bars_as_multiple_pwl of the indicator checks
+indicator_params = [(12, 30), (3, 15), (7, 5), (2, 10), (37, 13), (20, 50)]
+
+output_settings = {'order_full': False,
+                   'order_status': False,
+                   'trades': False,
+                   'performance': False,
+                   'plot': False
+                   }
+
+
+# Reference implementation of PivotPointLine: the bar by bar loop of the original pandas version on arrays.
+# The trend line of the bar 'i' is drawn by the bars i - history_bars_length ... i - 1. The original left the last
+# bar unfilled (NaN), the current indicator fills it, so the last bar isn't compared.
+def reference_pivot_point_line(open, high, low, close, pivot_window_len, history_bars_as_multiple_pwl):
+    history_bars_length = pivot_window_len * history_bars_as_multiple_pwl
+    n = len(close)
+    high_series, low_series = pd.Series(high), pd.Series(low)
+    high_left = high_series.rolling(pivot_window_len + 1).apply(np.max, raw=True).values
+    low_left = low_series.rolling(pivot_window_len + 1).apply(np.min, raw=True).values
+    high_right = high_series[::-1].rolling(pivot_window_len + 1).apply(np.max, raw=True)[::-1].values
+    low_right = low_series[::-1].rolling(pivot_window_len + 1).apply(np.min, raw=True)[::-1].values
+    pivot_up = (low == low_left) & (low == low_right)
+    pivot_down = (high == high_left) & (high == high_right)
+
+    pl_value = np.full(n, -1.0)
+    direction = np.zeros(n)
+    for i in range(history_bars_length, n):
+        first = i - history_bars_length
+        bar_direction = 0.0
+        pivot_line = -1.0
+        signals = []
+        # LONG direction based on Pivot Down points, SHORT direction based on Pivot Up points
+        for pivots, prices, beyond, side in ((pivot_down, high, np.greater, 1.0), (pivot_up, low, np.less, -1.0)):
+            pivots_window, prices_window = pivots[first:i], prices[first:i]
+            signal = False
+            potential = np.flatnonzero(pivots_window[:-pivot_window_len])
+            if len(potential) > 0:
+                ind_current = potential[-1] + 1
+                price_current = prices_window[ind_current - 1]
+                prev = np.flatnonzero(beyond(prices_window[:ind_current - 1], price_current) &
+                                      pivots_window[:ind_current - 1])
+                if len(prev) > 0:
+                    dydx_ratio = (price_current - prices_window[prev[-1]]) / (ind_current - prev[-1] - 1)
+                    pivot_line = price_current + dydx_ratio * (history_bars_length - ind_current)
+                    if side > 0:
+                        signal = dydx_ratio < 0 and close[i - 1] > pivot_line > open[i - 1]
+                    else:
+                        signal = dydx_ratio > 0 and close[i - 1] < pivot_line < open[i - 1]
+                    if signal:
+                        bar_direction = side
+            signals.append(signal)
+
+        # Set values only if we don't get 2 directions at the same time
+        if not all(signals):
+            pl_value[i] = pivot_line
+            direction[i] = bar_direction
+
+    return pivot_up.astype(float), pivot_down.astype(float), pl_value, direction
+
+
+# Lines of pivot_point_line against the reference implementation
+def check_indicator(args):
+    failed = 0
+    total = 0
+    for file in files:
+        candles = load_finam_candles(file)
+        for p in indicator_params:
+            start = time.perf_counter()
+            reference = reference_pivot_point_line(candles.open, candles.high, candles.low, candles.close, *p)
+            time_reference = time.perf_counter() - start
+            start = time.perf_counter()
+            outputs = pivot_point_line_lines(candles.open, candles.high, candles.low, candles.close, *p)
+            time_fast = time.perf_counter() - start
+
+            mismatches = [name for name, values, reference_values in
+                          zip(['pivot_up', 'pivot_down', 'pl_value', 'direction'], outputs, reference)
+                          if not np.array_equal(values[:-1], reference_values[:-1])]
+            failed += len(mismatches) > 0
+            total += 1
+            print('{0} {1} {2}: {3}, time {4:.3f}s / {5:.4f}s'.format(
+                'FAIL' if mismatches else 'OK  ', file, p,
+                'mismatched ' + ', '.join(mismatches) if mismatches else 'identical lines', time_reference, time_fast))
+
+    return failed, total
+
+
+# Results of the backtest by every engine: {engine: (final value, stability, time, returns)}
+def run_engines(file, candles, p, engines, window=None, compression=60):
+    algo_params = dict(zip(['pivot_window_len', 'history_bars_as_multiple_pwl',
+                            'fixed_tp', 'fixed_sl_as_multiple_tp'], p))
+    results = {}
+    for name in engines:
+        engine, _, block_size = name.partition('/')
+        backtest = BacktestTrendBreakerPL(file_data=file,
+                                          algo_params=algo_params,
+                                          output_settings=output_settings,
+                                          candles=candles,
+                                          window=window)
+        start = time.perf_counter()
+        backtest.run_strategy(cash=1000,
+                              commission=0.0004,
+                              tf=bt.TimeFrame.Minutes,
+                              compression=compression,
+                              engine=engine,
+                              block_size=int(block_size) if block_size else BLOCK_SIZE)
+        results[name] = (backtest.final_value, backtest.stability, time.perf_counter() - start,
+                           backtest.returns)
+    return results
+
+
+# The same final value, stability and returns (within the tolerance), the returns aren't kept by the chunked engine
+def same_results(result, other, tolerance):
+    (value, stability, _, returns), (other_value, other_stability, _, other_returns) = result, other
+    return abs(value - other_value) <= tolerance and \
+        (abs(stability - other_stability) <= tolerance or (np.isnan(stability) and np.isnan(other_stability))) and \
+        (returns is None or other_returns is None or (returns.index.equals(other_returns.index) and
+         np.max(np.abs(returns.values - other_returns.values), initial=0.0) <= tolerance))
+
+
+# Final value, stability and the returns of FastSimulator against cerebro
+def check_engines(args):
+    failed = 0
+    for file in files:
+        candles = load_finam_candles(file)
+        for p in params:
+            results = run_engines(file, candles, p, ['cerebro', 'fast'])
+            ok = same_results(results['cerebro'], results['fast'], args.tolerance)
+            failed += not ok
+            (value, stability, time_cerebro, _), (fast_value, fast_stability, time_fast, _) = \
+                results['cerebro'], results['fast']
+            print('{0} {1} {2}: value {3:.6f} / {4:.6f}, stability {5:.6f} / {6:.6f}, '
+                  'time {7:.3f}s / {8:.4f}s'.format('OK  ' if ok else 'FAIL', file, p, value, fast_value,
+                                                    stability, fast_stability, time_cerebro, time_fast))
+
+    return failed, len(files) * len(params)
+
+
+# The engines on the window against the first one of them, True if any of them mismatches
+def compare_engines(file, candles, p, engines, window, compression, tolerance):
+    results = run_engines(file, candles, p, engines, window, compression)
+    mismatched = [engine for engine in engines[1:] if not same_results(results[engines[0]], results[engine],
+                                                                       tolerance)]
+    print('{0} {1} {2}: {3}'.format('FAIL' if mismatched else 'OK  ', p, window, ', '.join(
+        '{0} {1:.6f} / {2:.6f}'.format(engine, results[engine][0], results[engine][1]) for engine in engines)))
+    return len(mismatched) > 0
+
+
+# The engines on the windows of the full dataset, with the indicator warmed up by the bars before the window
+def check_windows(args):
+    failed = 0
+    candles = load_finam_candles(window_file)
+    for p in params[:3]:
+        for window in windows:
+            failed += compare_engines(window_file, candles, p, window_engines, window, 60, args.tolerance)
+
+    return failed, len(params[:3]) * len(windows)
+
+
+# The engines on the resampled candles of the full dataset, the chunked one slices them instead of reading the cache
+def check_resampled(args):
+    failed = 0
+    candles = resample_candles(load_finam_candles(window_file), bt.TimeFrame.Minutes, resampled_compression)
+    for p in params[:3]:
+        for window in resampled_windows:
+            failed += compare_engines(window_file, candles, p, window_engines, window, resampled_compression,
+                                      args.tolerance)
+
+    return failed, len(params[:3]) * len(resampled_windows)
+
+
+# Strategy keeping PivotPointLine only, for reading its lines after the run
+class IndicatorLines(bt.Strategy):
+    params = (
+        ('pivot_window_len', 12),
+        ('history_bars_as_multiple_pwl', 30)
+    )
+
+    def __init__(self):
+        self.pivot_point_line = PivotPointLine(self.data,
+                                               pivot_window_len=self.params.pivot_window_len,
+                                               history_bars_as_multiple_pwl=self.params.history_bars_as_multiple_pwl)
+
+    # The arrays of the bar by bar mode are preallocated beyond the bars of the data
+    def lines_arrays(self):
+        return [np.asarray(line.array)[:len(self)] for line in self.pivot_point_line.lines]
+
+
+# Lines of PivotPointLine in cerebro with runonce=True (once) or runonce=False (next)
+def cerebro_indicator_lines(candles, pivot_window_len, history_bars_as_multiple_pwl, runonce):
+    cerebro = bt.Cerebro(runonce=runonce, stdstats=False)
+    cerebro.adddata(FinamArrays(dataname=candles, timeframe=bt.TimeFrame.Minutes, compression=60))
+    cerebro.addstrategy(IndicatorLines, pivot_window_len=pivot_window_len,
+                        history_bars_as_multiple_pwl=history_bars_as_multiple_pwl)
+    return cerebro.run()[0].lines_arrays()
+
+
+# Lines of PivotPointLineStream filled the same way as PivotPointLine.next fills them
+def stream_indicator_lines(open, high, low, close, pivot_window_len, history_bars_as_multiple_pwl):
+    stream = PivotPointLineStream(pivot_window_len=pivot_window_len,
+                                  history_bars_as_multiple_pwl=history_bars_as_multiple_pwl)
+    outputs = [np.zeros(len(close)) for _ in range(4)]
+    for i in range(len(close)):
+        pivot_up, pivot_down, outputs[2][i], outputs[3][i] = stream.update(open[i], high[i], low[i], close[i])
+        if pivot_up is not None:
+            outputs[0][i - pivot_window_len] = pivot_up
+            outputs[1][i - pivot_window_len] = pivot_down
+    return outputs
+
+
+# Random walk candles on the grid of 0.1, so many highs and lows are equal
+def tied_candles(rng, num_bars):
+    close = np.round(100.0 + np.cumsum(rng.choice([-0.1, 0.0, 0.1], num_bars)), 1)
+    open = np.concatenate(([100.0], close[:-1]))
+    high = np.maximum(open, close) + rng.choice([0.0, 0.1], num_bars)
+    low = np.minimum(open, close) - rng.choice([0.0, 0.1], num_bars)
+    return open, high, low, close
+
+
+# Lines of the bar by bar mode against the batch one, including the last bar
+def check_next(args):
+    names = ['pivot_up', 'pivot_down', 'pl_value', 'direction']
+    failed = 0
+    total = 0
+    for file in files:
+        candles = load_finam_candles(file)
+        for p in indicator_params[:4]:
+            batch = cerebro_indicator_lines(candles, *p, runonce=True)
+            bar_by_bar = cerebro_indicator_lines(candles, *p, runonce=False)
+            mismatches = [name for name, values, batch_values in zip(names, bar_by_bar, batch)
+                          if not np.array_equal(values, batch_values)]
+            failed += len(mismatches) > 0
+            total += 1
+            print('{0} {1} {2}: {3}'.format('FAIL' if mismatches else 'OK  ', file, p,
+                                             'mismatched ' + ', '.join(mismatches) if mismatches
+                                             else 'identical lines of {0} bars'.format(len(batch[0]))))
+
+    rng = np.random.RandomState(0)
+    fuzz_failed = 0
+    for _ in range(args.fuzz):
+        open, high, low, close = tied_candles(rng, rng.randint(50, 600))
+        p = (rng.randint(1, 8), rng.randint(1, 10))
+        stream = stream_indicator_lines(open, high, low, close, *p)
+        batch = pivot_point_line_lines(open, high, low, close, *p)
+        fuzz_failed += any(not np.array_equal(values, batch_values) for values, batch_values in zip(stream, batch))
+    failed += fuzz_failed > 0
+    total += 1
+    print('{0} {1} random candles with ties: {2} mismatched'.format('FAIL' if fuzz_failed else 'OK  ', args.fuzz,
+                                                                   fuzz_failed))
+
+    return failed, total
+
+
+CHECKS = {'engines': check_engines,
+          'windows': check_windows,
+          'resampled': check_resampled,
+          'indicator': check_indicator,
+          'next': check_next}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parity checks of the fast paths with the reference ones')
+    parser.add_argument('--checks', default=','.join(CHECKS),
+                        help='comma separated checks to run: ' + ', '.join(CHECKS))
+    parser.add_argument('--tolerance', type=float, default=1e-9, help='max absolute difference of the results')
+    parser.add_argument('--fuzz', type=int, default=200, help='number of the random candle series of the next check')
+    parser.add_argument('--no-jit', action='store_true', help='run FastSimulator as plain Python')
+    args = parser.parse_args()
+
+    if args.no_jit:
+        FastSimulator.simulate_core_jit = None
+        FastSimulator.simulate_batch_core_jit = None
+
+    failed = 0
+    for name in args.checks.split(','):
+        print('Check: ' + name)
+        check_failed, check_total = CHECKS[name](args)
+        print('Mismatches: {0} of {1}'.format(check_failed, check_total))
+        failed += check_failed
+
+    exit(1 if failed else 0)
@@ -0,0 +1,39 @@
+from ResultStore import ResultStore, RUN_COLUMNS
+import backtrader as bt
+import pandas as pd
+import argparse
+
+# Query of the backtest runs stored by --results, e.g. all runs with the stability above 0.8 on SBER hourly:
+# python results.py results.sqlite --instrument SBER --compression 60 --min-stability 0.8
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query of the stored TrendBreakerPL backtest runs')
+    parser.add_argument('store', help='SQLite file of the results')
+    parser.add_argument('--instrument', default=None, help='ticker of the dataset, e.g. SBER')
+    parser.add_argument('--engine', default=None, help='engine of the runs')
+    parser.add_argument('--timeframe', choices=bt.TimeFrame.Names[1:], default=None, help='timeframe of the runs')
+    parser.add_argument('--compression', type=int, default=None, help='compression of the runs')
+    parser.add_argument('--min-stability', type=float, default=None, help='lowest stability of the runs')
+    parser.add_argument('--max-stability', type=float, default=None, help='highest stability of the runs')
+    parser.add_argument('--order-by', choices=list(RUN_COLUMNS), default='stability', help='column of the order')
+    parser.add_argument('--ascending', action='store_true', help='ascending order instead of descending')
+    parser.add_argument('--limit', type=int, default=20, help='number of the runs printed')
+    parser.add_argument('--output', default=None, help='csv file for the runs')
+    args = parser.parse_args()
+
+    conditions = {name: value for name, value in (('instrument', args.instrument),
+                                                  ('engine', args.engine),
+                                                  ('compression', args.compression)) if value is not None}
+    if args.timeframe is not None:
+        conditions['timeframe'] = bt.TimeFrame.Names.index(args.timeframe)
+    if args.min_stability is not None or args.max_stability is not None:
+        conditions['stability'] = (args.min_stability, args.max_stability)
+
+    store = ResultStore(args.store)
+    runs = store.query(order_by=args.order_by, descending=not args.ascending, limit=args.limit, **conditions)
+    print('{0} runs stored, {1} matching'.format(len(store), len(runs)))
+    with pd.option_context('display.width', 250, 'display.max_columns', None):
+        print(runs.drop(columns=['dataset', 'code_version']))
+
+    if args.output is not None:
+        runs.to_csv(args.output)
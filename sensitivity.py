@@ -0,0 +1,49 @@
+from SensitivityGrid import SensitivityGrid, sensitivity_grid, plot_sensitivity
+import pandas as pd
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+
+# Sensitivity of the TrendBreakerPL stability to the params around the optimum, e.g. 10k points:
+# python sensitivity.py --center 12,30,0.08,0.15 --steps 45 --pwl-span 2 --plot sensitivity.png
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parameter-sensitivity grid of the TrendBreakerPL strategy')
+    parser.add_argument('--file', default='./data/SBER_140101_171231_hourly_train.csv', help='Finam csv file')
+    parser.add_argument('--center', default='12,30,0.08,0.15',
+                        help='params in the center of the grid: pivot_window_len,history_bars_as_multiple_pwl,'
+                             'fixed_tp,fixed_sl_as_multiple_tp')
+    parser.add_argument('--relative', type=float, default=0.2, help='range of TP & SL as the fraction of the center')
+    parser.add_argument('--steps', type=int, default=21, help='number of the values of TP and of SL')
+    parser.add_argument('--pwl-span', type=int, default=2, help='neighbors of pivot_window_len on every side')
+    parser.add_argument('--hbm-span', type=int, default=0,
+                        help='neighbors of history_bars_as_multiple_pwl on every side')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes evaluating the grid')
+    parser.add_argument('--chunk-size', type=int, default=512, help='number of the points simulated together')
+    parser.add_argument('--indicator-cache-dir', default=None,
+                        help='directory for PivotPointLine results shared by the workers on disk')
+    parser.add_argument('--plot', default=None, help='image file for the heatmaps of the stability (shown if not set)')
+    parser.add_argument('--no-plot', action='store_true', help='don\'t plot the heatmaps')
+    parser.add_argument('--output', default=None, help='csv file for the results of the grid')
+    args = parser.parse_args()
+
+    # Bounds for parameters space
+    lb = [2, 10, 0.01, 0.1]
+    ub = [120, 100, 0.2, 1.5]
+
+    grid = sensitivity_grid([float(value) for value in args.center.split(',')], relative=args.relative,
+                            steps=args.steps, pwl_span=args.pwl_span, hbm_span=args.hbm_span, lb=lb, ub=ub)
+    runner = SensitivityGrid(args.file, grid, workers=args.workers, chunk_size=args.chunk_size,
+                             indicator_cache_dir=args.indicator_cache_dir)
+    results = runner.run()
+
+    with pd.option_context('display.width', 250, 'display.max_columns', None):
+        print(results.sort_values('stability', ascending=False).head(10))
+        print(results.groupby(['pivot_window_len', 'history_bars_as_multiple_pwl'])['stability'].describe())
+    print('Points: {0}, evaluation time: {1:.1f}s, wall-clock time: {2:.1f}s on {3} workers'.format(
+        len(results), runner.eval_time, runner.wall_time, args.workers))
+
+    if args.output is not None:
+        results.to_csv(args.output)
+    if not args.no_plot:
+        plot_sensitivity(results, file_name=args.plot)
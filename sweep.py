@@ -0,0 +1,28 @@
+from SweepRunner import SweepRunner, read_manifest
+import pandas as pd
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+
+# Optimization of TrendBreakerPL for the jobs of the manifest: instruments, timeframes and params bounds
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep of the TrendBreakerPL optimizations over the manifest jobs')
+    parser.add_argument('manifest', nargs='?', default='sweep_manifest.json', help='JSON manifest of the jobs')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes running the jobs')
+    parser.add_argument('--indicator-cache-dir', default=None,
+                        help='directory for PivotPointLine results shared by the workers on disk')
+    parser.add_argument('--output', default=None, help='csv file for the results table')
+    args = parser.parse_args()
+
+    runner = SweepRunner(read_manifest(args.manifest), workers=args.workers,
+                         indicator_cache_dir=args.indicator_cache_dir)
+    results = runner.run()
+
+    with pd.option_context('display.width', 250, 'display.max_columns', None):
+        print(results)
+    print('Jobs time: {0:.1f}s, wall-clock time: {1:.1f}s on {2} workers'.format(
+        results['time'].sum(), runner.wall_time, args.workers))
+
+    if args.output is not None:
+        results.to_csv(args.output)
@@ -0,0 +1,43 @@
+from WalkForward import WalkForward
+import pandas as pd
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+
+# Walk-forward optimization of TrendBreakerPL over the full SBER history
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk-forward optimization of the TrendBreakerPL strategy')
+    parser.add_argument('--file', default='./data/SBER_140101_200224_hourly_full.csv', help='Finam csv file')
+    parser.add_argument('--train-months', type=int, default=24, help='length of the train window')
+    parser.add_argument('--test-months', type=int, default=6, help='length of the test window and the step')
+    parser.add_argument('--anchored', action='store_true', help='train windows start at the first month')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes running the folds')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the swarm random numbers')
+    parser.add_argument('--swarmsize', type=int, default=20, help='number of particles in the swarm')
+    parser.add_argument('--maxiter', type=int, default=40, help='maximum number of iterations')
+    parser.add_argument('--indicator-cache-dir', default=None,
+                        help='directory for PivotPointLine results shared by the workers on disk')
+    parser.add_argument('--output', default=None, help='csv file for the report of the folds')
+    args = parser.parse_args()
+
+    walk_forward = WalkForward(args.file,
+                               train_months=args.train_months,
+                               test_months=args.test_months,
+                               anchored=args.anchored,
+                               swarmsize=args.swarmsize,
+                               maxiter=args.maxiter,
+                               seed=args.seed,
+                               workers=args.workers,
+                               indicator_cache_dir=args.indicator_cache_dir)
+    report = walk_forward.run()
+
+    with pd.option_context('display.width', 250, 'display.max_columns', None):
+        print(report)
+    for name, value in WalkForward.summary(report).items():
+        print('{0}: {1}'.format(name, value))
+    print('Folds optimization time: {0:.1f}s, wall-clock time: {1:.1f}s on {2} workers'.format(
+        report['time'].sum(), walk_forward.wall_time, args.workers))
+
+    if args.output is not None:
+        report.to_csv(args.output)